@@ -2,19 +2,43 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import json
+import functools
 import argparse
+import asyncio
 import time
+import random
 import sys
+import traceback
 import requests
+import httpx
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Set
 import logging
 
 from tqdm import tqdm
 from dotenv import load_dotenv
 
+# orjson is much faster than the stdlib json module but optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# HTTP/2 multiplexing in httpx needs the optional h2 package
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -22,9 +46,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
 # Constants
 API_BASE_URL = "http://localhost:8000/api"
 MODEL_NAME = "agir-learner"
@@ -33,10 +54,59 @@ INPUT_FILE = "EU.jsonl"
 RESULTS_DIR = "results"
 BASE_MODEL_DIR = "emotion-master"
 
+# Shared HTTP session so connections are kept alive and reused across requests
+# and worker threads. Retries are handled in query_agir_api, not by urllib3.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
+
+# Request pieces that are identical for every item; only the prompt varies
+REQUEST_HEADERS = {"Content-Type": "application/json"}
+PAYLOAD_TEMPLATE = {
+    "model": MODEL_NAME,
+    "max_tokens": 500,
+    "temperature": 0,
+    "user_id": USER_ID
+}
+
+PROMPT_TEMPLATE = """Given the following scenario, identify the emotion of the subject and the cause of that emotion.
+
+Scenario: {scenario}
+
+Subject: {subject}
+
+Emotion choices: {emotion_choices}
+
+Cause choices: {cause_choices}
+
+Provide your answer in JSON format with two fields: "emotion" and "cause".
+"""
+
+# Patterns used to pull the answer out of free-form API text
+JSON_OBJECT_PATTERN = re.compile(r'\{[^}]*"emotion"[^}]*"cause"[^}]*\}')
+EMOTION_PATTERN = re.compile(r'"emotion"\s*:\s*"([^"]*)"')
+CAUSE_PATTERN = re.compile(r'"cause"\s*:\s*"([^"]*)"')
+
+# Upper bound for a single retry wait, in seconds
+MAX_RETRY_DELAY = 60
+
+# Cleared the first time the server rejects a list of prompts, after which
+# every item is sent on its own
+BATCH_PROMPTS_SUPPORTED = True
+# Statuses meaning the server does not accept a list of prompts; any other failure is treated as transient
+BATCH_UNSUPPORTED_STATUSES = (400, 404, 422)
+
+# Rewrite the progress file only after this many newly saved results
+PROGRESS_FLUSH_INTERVAL = 10
+
 # These will be set dynamically in setup_directories()
 MODEL_RESULTS_DIR = ""
 PROGRESS_FILE = ""
 RESULTS_FILE = ""
+RESULTS_FH = None
+
+# Completed (result, qid) pairs waiting for the background writer; None stops it
+WRITE_QUEUE = queue.Queue(maxsize=1024)
 
 def setup_directories() -> None:
     """Create necessary directories if they don't exist, with versioning support."""
@@ -76,91 +146,129 @@ def setup_directories() -> None:
     logger.info(f"Progress file: {PROGRESS_FILE}")
     logger.info(f"Results file: {RESULTS_FILE}")
 
-def load_data(file_path: str) -> List[Dict[str, Any]]:
-    """Load data from JSONL file."""
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as f:
+@functools.lru_cache(maxsize=1)
+def load_env() -> None:
+    """Load environment variables from .env, parsing the file at most once per process."""
+    load_dotenv()
+
+def json_loads(data: Any) -> Any:
+    """Parse JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize an object to UTF-8 encoded JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+def format_json(obj: Any, indent: bool = True) -> str:
+    """Render an object as JSON text for log messages."""
+    return json_dumps(obj, indent=indent).decode('utf-8')
+
+def iter_data(file_path: str) -> Iterator[Dict[str, Any]]:
+    """Stream records from a JSONL file one at a time."""
+    with open(file_path, 'rb') as f:
         for line in f:
-            data.append(json.loads(line))
-    return data
+            yield json_loads(line)
 
 def save_progress(processed_ids: List[str]) -> None:
-    """Save progress information."""
-    with open(PROGRESS_FILE, 'w', encoding='utf-8') as f:
-        json.dump({"processed_ids": processed_ids, "updated_at": datetime.now().isoformat()}, f)
+    """Save progress information, flushing buffered results first so they are never behind it."""
+    RESULTS_FH.flush()
+    with open(PROGRESS_FILE, 'wb') as f:
+        f.write(json_dumps({"processed_ids": processed_ids, "updated_at": datetime.now().isoformat()}))
 
 def load_progress() -> List[str]:
     """Load progress information if it exists."""
-    if Path(PROGRESS_FILE).exists():
-        with open(PROGRESS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f).get("processed_ids", [])
-    return []
+    # Opening directly avoids a separate stat call just to check for existence
+    try:
+        with open(PROGRESS_FILE, 'rb') as f:
+            return json_loads(f.read()).get("processed_ids", [])
+    except FileNotFoundError:
+        return []
 
 def save_result(result: Dict[str, Any]) -> None:
     """Save a single result to the results file."""
-    with open(RESULTS_FILE, 'a', encoding='utf-8') as f:
-        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    RESULTS_FH.write(json_dumps(result) + b'\n')
+
+@functools.lru_cache(maxsize=1024)
+def join_choices(choices: tuple) -> str:
+    """Join a choice list for the prompt; many items share the same choices."""
+    return ", ".join(choices)
 
 def create_prompt(item: Dict[str, Any]) -> str:
     """Create a prompt for agir-learner based on the item."""
-    scenario = item["scenario"]
-    subject = item["subject"]
-    emotion_choices = item["emotion_choices"]
-    cause_choices = item["cause_choices"]
-    
-    prompt = f"""Given the following scenario, identify the emotion of the subject and the cause of that emotion.
-
-Scenario: {scenario}
-
-Subject: {subject}
-
-Emotion choices: {", ".join(emotion_choices)}
+    return PROMPT_TEMPLATE.format(
+        scenario=item["scenario"],
+        subject=item["subject"],
+        emotion_choices=join_choices(tuple(item["emotion_choices"])),
+        cause_choices=join_choices(tuple(item["cause_choices"]))
+    )
 
-Cause choices: {", ".join(cause_choices)}
+def extract_answer(text_content: str) -> Dict[str, Any]:
+    """Extract the emotion/cause answer from API text, raising JSONDecodeError if none is found."""
+    # Fast path: the whole text is a JSON object (surrounding whitespace is fine)
+    try:
+        parsed_result = json_loads(text_content)
+        if isinstance(parsed_result, dict):
+            return parsed_result
+    except json.JSONDecodeError:
+        pass
+    
+    # The text might contain extra content, try to find an embedded JSON object
+    json_match = JSON_OBJECT_PATTERN.search(text_content)
+    if json_match:
+        logger.debug("Found JSON pattern: %s", json_match.group())
+        return json_loads(json_match.group())
+    
+    # If no proper JSON found, try to extract emotion and cause manually
+    emotion_match = EMOTION_PATTERN.search(text_content)
+    cause_match = CAUSE_PATTERN.search(text_content)
+    
+    if emotion_match and cause_match:
+        return {
+            "emotion": emotion_match.group(1),
+            "cause": cause_match.group(1)
+        }
+    
+    logger.error(f"Could not extract emotion and cause from: {text_content}")
+    logger.error(f"Emotion match: {emotion_match}")
+    logger.error(f"Cause match: {cause_match}")
+    raise json.JSONDecodeError("Could not extract structured data", text_content, 0)
 
-Provide your answer in JSON format with two fields: "emotion" and "cause".
-"""
-    return prompt
+def backoff_delay(attempt: int, retry_delay: float) -> float:
+    """Exponential backoff with jitter so concurrent workers don't retry in lockstep."""
+    return min(retry_delay * (2 ** attempt) + random.uniform(0, retry_delay), MAX_RETRY_DELAY)
 
 def query_agir_api(prompt: str, retries: int = 3, retry_delay: int = 5) -> Optional[Dict[str, Any]]:
     """Query the agir emotion master API with retry logic."""
     url = f"{API_BASE_URL}/completions"
-    
-    payload = {
-        "prompt": prompt,
-        "model": MODEL_NAME,
-        "max_tokens": 500,
-        "temperature": 0,
-        "user_id": USER_ID
-    }
-    
-    headers = {
-        "Content-Type": "application/json"
-    }
+    payload = PAYLOAD_TEMPLATE | {"prompt": prompt}
     
     for attempt in range(retries):
         try:
-            logger.info(f"=== API Request Attempt {attempt + 1}/{retries} ===")
-            logger.info(f"URL: {url}")
-            logger.info(f"Headers: {headers}")
-            logger.info(f"Payload: {json.dumps(payload, indent=2, ensure_ascii=False)}")
+            # Per-request details are DEBUG only and formatted lazily to keep the hot path cheap
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("=== API Request Attempt %d/%d ===", attempt + 1, retries)
+                logger.debug("URL: %s", url)
+                logger.debug("Headers: %s", REQUEST_HEADERS)
+                logger.debug("Payload: %s", format_json(payload, indent=False))
             
-            import time
             start_time = time.time()
-            logger.info(f"Making API request at {time.strftime('%Y-%m-%d %H:%M:%S')}")
             
-            response = requests.post(url, json=payload, headers=headers, timeout=120)
+            response = SESSION.post(url, json=payload, headers=REQUEST_HEADERS, timeout=120)
             
-            end_time = time.time()
-            duration = end_time - start_time
-            logger.info(f"Request completed in {duration:.2f} seconds")
-            logger.info(f"Response status code: {response.status_code}")
-            logger.info(f"Response headers: {dict(response.headers)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Request completed in %.2f seconds", time.time() - start_time)
+                logger.debug("Response status code: %s", response.status_code)
+                logger.debug("Response headers: %s", dict(response.headers))
             
             if response.status_code == 200:
                 try:
                     response_data = response.json()
-                    logger.info(f"Response JSON: {json.dumps(response_data, indent=2, ensure_ascii=False)}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Response JSON: %s", format_json(response_data, indent=False))
                 except json.JSONDecodeError as je:
                     logger.error(f"Failed to parse response as JSON: {je}")
                     logger.error(f"Raw response text: {repr(response.text)}")
@@ -169,13 +277,14 @@ def query_agir_api(prompt: str, retries: int = 3, retry_delay: int = 5) -> Optio
                 # Extract the text from choices
                 if "choices" in response_data and len(response_data["choices"]) > 0:
                     text_content = response_data["choices"][0].get("text", "")
-                    logger.info(f"Extracted text content: {repr(text_content)}")
+                    logger.debug("Extracted text content: %r", text_content)
                     
                     if not text_content.strip():
                         logger.error("Received empty text content from API")
                         if attempt < retries - 1:
-                            logger.info(f"Retrying in {retry_delay} seconds...")
-                            time.sleep(retry_delay)
+                            delay = backoff_delay(attempt, retry_delay)
+                            logger.info(f"Retrying in {delay:.1f} seconds...")
+                            time.sleep(delay)
                             continue
                         else:
                             logger.error("Empty response after all retries. Exiting.")
@@ -183,49 +292,16 @@ def query_agir_api(prompt: str, retries: int = 3, retry_delay: int = 5) -> Optio
                     
                     # Try to parse JSON from the text content
                     try:
-                        # The text might contain extra content, try to find JSON
-                        text_content = text_content.strip()
-                        logger.info(f"Attempting to parse JSON from: {repr(text_content)}")
-                        
-                        # Look for JSON-like content
-                        if text_content.startswith('{') and text_content.endswith('}'):
-                            parsed_result = json.loads(text_content)
-                            logger.info(f"Successfully parsed JSON: {parsed_result}")
-                            return parsed_result
-                        else:
-                            # Try to extract JSON from the text
-                            import re
-                            json_match = re.search(r'\{[^}]*"emotion"[^}]*"cause"[^}]*\}', text_content)
-                            if json_match:
-                                json_str = json_match.group()
-                                logger.info(f"Found JSON pattern: {json_str}")
-                                parsed_result = json.loads(json_str)
-                                logger.info(f"Successfully parsed extracted JSON: {parsed_result}")
-                                return parsed_result
-                            else:
-                                # If no proper JSON found, try to extract emotion and cause manually
-                                emotion_match = re.search(r'"emotion"\s*:\s*"([^"]*)"', text_content)
-                                cause_match = re.search(r'"cause"\s*:\s*"([^"]*)"', text_content)
-                                
-                                if emotion_match and cause_match:
-                                    extracted_result = {
-                                        "emotion": emotion_match.group(1),
-                                        "cause": cause_match.group(1)
-                                    }
-                                    logger.info(f"Manually extracted emotion and cause: {extracted_result}")
-                                    return extracted_result
-                                else:
-                                    logger.error(f"Could not extract emotion and cause from: {text_content}")
-                                    logger.error(f"Emotion match: {emotion_match}")
-                                    logger.error(f"Cause match: {cause_match}")
-                                    raise json.JSONDecodeError("Could not extract structured data", text_content, 0)
-                        
+                        parsed_result = extract_answer(text_content)
+                        logger.debug("Parsed answer: %s", parsed_result)
+                        return parsed_result
                     except json.JSONDecodeError as je:
                         logger.error(f"JSON decode error: {je}")
                         logger.error(f"Content that failed to parse: {repr(text_content)}")
                         if attempt < retries - 1:
-                            logger.info(f"Retrying in {retry_delay} seconds...")
-                            time.sleep(retry_delay)
+                            delay = backoff_delay(attempt, retry_delay)
+                            logger.info(f"Retrying in {delay:.1f} seconds...")
+                            time.sleep(delay)
                             continue
                         else:
                             logger.error("Non-JSON response received after all retries. Exiting.")
@@ -234,8 +310,9 @@ def query_agir_api(prompt: str, retries: int = 3, retry_delay: int = 5) -> Optio
                     logger.error("No choices in API response")
                     logger.error(f"Full response structure: {response_data}")
                     if attempt < retries - 1:
-                        logger.info(f"Retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
+                        delay = backoff_delay(attempt, retry_delay)
+                        logger.info(f"Retrying in {delay:.1f} seconds...")
+                        time.sleep(delay)
                         continue
                     else:
                         logger.error("No choices after all retries. Exiting.")
@@ -245,8 +322,9 @@ def query_agir_api(prompt: str, retries: int = 3, retry_delay: int = 5) -> Optio
                 logger.error(f"Response headers: {dict(response.headers)}")
                 logger.error(f"Response text: {response.text}")
                 if attempt < retries - 1:
-                    logger.info(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
+                    delay = backoff_delay(attempt, retry_delay)
+                    logger.info(f"Retrying in {delay:.1f} seconds...")
+                    time.sleep(delay)
                 else:
                     logger.error("Max retries reached. Exiting.")
                     sys.exit(1)
@@ -254,35 +332,38 @@ def query_agir_api(prompt: str, retries: int = 3, retry_delay: int = 5) -> Optio
         except requests.exceptions.Timeout as e:
             logger.error(f"Request timeout after 120 seconds (attempt {attempt+1}/{retries}): {str(e)}")
             if attempt < retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                delay = backoff_delay(attempt, retry_delay)
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
             else:
                 logger.error("Max retries reached due to timeout. Exiting.")
                 sys.exit(1)
         except requests.exceptions.ConnectionError as e:
             logger.error(f"Connection error (attempt {attempt+1}/{retries}): {str(e)}")
             if attempt < retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                delay = backoff_delay(attempt, retry_delay)
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
             else:
                 logger.error("Max retries reached due to connection error. Exiting.")
                 sys.exit(1)
         except requests.exceptions.RequestException as e:
             logger.error(f"Request error (attempt {attempt+1}/{retries}): {str(e)}")
             if attempt < retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                delay = backoff_delay(attempt, retry_delay)
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
             else:
                 logger.error("Max retries reached. Exiting.")
                 sys.exit(1)
         except Exception as e:
             logger.error(f"Unexpected error (attempt {attempt+1}/{retries}): {str(e)}")
             logger.error(f"Error type: {type(e).__name__}")
-            import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
             if attempt < retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                delay = backoff_delay(attempt, retry_delay)
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
             else:
                 logger.error("Max retries reached. Exiting.")
                 sys.exit(1)
@@ -311,58 +392,317 @@ def evaluate_responses(api_response: Dict[str, str], item: Dict[str, Any]) -> Di
         "both_correct": emotion_correct and cause_correct
     }
 
-def run_test(data: List[Dict[str, Any]], limit: Optional[int] = None, resume: bool = False) -> None:
-    """Run the test on the provided data."""
-    processed_ids = load_progress() if resume else []
+def new_counts() -> Dict[str, int]:
+    """Create zeroed correctness counters for a test run."""
+    return {"total": 0, "emotion_correct": 0, "cause_correct": 0, "both_correct": 0}
+
+def summarize_counts(counts: Dict[str, int]) -> Dict[str, Any]:
+    """Turn correctness counters into the accuracy summary."""
+    total = counts["total"]
+    return {
+        "total_items": total,
+        "emotion_accuracy": counts["emotion_correct"] / total if total > 0 else 0,
+        "cause_accuracy": counts["cause_correct"] / total if total > 0 else 0,
+        "both_correct_accuracy": counts["both_correct"] / total if total > 0 else 0
+    }
+
+def result_writer(processed_ids: List[str], processed_set: Set[str], counts: Dict[str, int]) -> None:
+    """Drain WRITE_QUEUE, appending results, updating counts and periodically saving progress.
     
-    # Filter out already processed items if resuming
-    if resume and processed_ids:
-        logger.info(f"Resuming from previous run. {len(processed_ids)} items already processed.")
-        data_to_process = [item for item in data if item["qid"] not in processed_ids]
+    processed_set mirrors processed_ids for O(1) membership checks; the list is
+    kept only so progress.json preserves completion order.
+    """
+    unsaved_count = 0
+    while True:
+        entry = WRITE_QUEUE.get()
+        try:
+            if entry is None:
+                break
+            result, qid = entry
+            save_result(result)
+            counts["total"] += 1
+            counts["emotion_correct"] += result["emotion_correct"]
+            counts["cause_correct"] += result["cause_correct"]
+            counts["both_correct"] += result["both_correct"]
+            if qid not in processed_set:
+                processed_set.add(qid)
+                processed_ids.append(qid)
+            unsaved_count += 1
+            if unsaved_count >= PROGRESS_FLUSH_INTERVAL:
+                save_progress(processed_ids)
+                unsaved_count = 0
+        finally:
+            WRITE_QUEUE.task_done()
+    
+    # Final flush so progress covers every saved result
+    save_progress(processed_ids)
+
+def process_item(item: Dict[str, Any]) -> None:
+    """Query the API for a single item and hand the evaluated result to the writer."""
+    api_response = query_agir_api(create_prompt(item))
+    
+    if api_response:
+        WRITE_QUEUE.put((evaluate_responses(api_response, item), item["qid"]))
     else:
-        data_to_process = data
+        logger.warning(f"Skipping item {item['qid']} due to failed API query.")
+
+def query_agir_api_batch(prompts: List[str]) -> Optional[List[Optional[Dict[str, Any]]]]:
+    """Send several prompts in one request, returning one parsed answer (or None) per prompt.
+    
+    Returns None when the server does not accept a list of prompts, so the
+    caller can fall back to single-prompt requests.
+    """
+    global BATCH_PROMPTS_SUPPORTED
+    
+    url = f"{API_BASE_URL}/completions"
+    payload = PAYLOAD_TEMPLATE | {"prompt": prompts}
+    
+    try:
+        response = SESSION.post(url, json=payload, headers=REQUEST_HEADERS, timeout=120)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Batch request failed, falling back to single requests: {str(e)}")
+        return None
+    
+    if response.status_code in BATCH_UNSUPPORTED_STATUSES:
+        logger.warning(f"Server rejected batched prompts with status {response.status_code}; "
+                       "sending prompts one at a time from now on")
+        BATCH_PROMPTS_SUPPORTED = False
+        return None
+    if response.status_code != 200:
+        # e.g. 429 or 5xx: only this batch is sent one prompt at a time
+        logger.warning(f"Batch request failed with status {response.status_code}, "
+                       "falling back to single requests for this batch")
+        return None
+    
+    try:
+        choices = json_loads(response.content).get("choices", [])
+    except json.JSONDecodeError as je:
+        logger.warning(f"Could not parse batch response, falling back to single requests: {je}")
+        return None
+    
+    if len(choices) != len(prompts):
+        logger.warning(f"Batch response has {len(choices)} choices for {len(prompts)} prompts; "
+                       "sending prompts one at a time from now on")
+        BATCH_PROMPTS_SUPPORTED = False
+        return None
+    
+    # Choices carry an index when the server reorders them
+    choices = sorted(choices, key=lambda choice: choice.get("index", 0))
+    
+    answers = []
+    for choice in choices:
+        try:
+            answers.append(extract_answer(choice.get("text", "")))
+        except json.JSONDecodeError:
+            answers.append(None)
+    return answers
+
+def process_batch(batch: List[Dict[str, Any]]) -> None:
+    """Query the API for a batch of items, retrying individually any that did not parse."""
+    answers = None
+    if len(batch) > 1 and BATCH_PROMPTS_SUPPORTED:
+        answers = query_agir_api_batch([create_prompt(item) for item in batch])
+    
+    if answers is None:
+        for item in batch:
+            process_item(item)
+        return
+    
+    for item, api_response in zip(batch, answers):
+        if api_response:
+            WRITE_QUEUE.put((evaluate_responses(api_response, item), item["qid"]))
+        else:
+            process_item(item)
+
+def iter_batches(data: Iterable[Dict[str, Any]], batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Group items into lists of at most batch_size."""
+    iterator = iter(data)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def progress_bar_options(total: int) -> Dict[str, Any]:
+    """tqdm settings that redraw at most once a second and roughly every 0.5% of items."""
+    return {"mininterval": 1.0, "miniters": max(1, total // 200), "smoothing": 0}
+
+def select_items(data: Iterable[Dict[str, Any]], processed_set: Set[str], limit: Optional[int] = None,
+                 resume: bool = False) -> Iterable[Dict[str, Any]]:
+    """Lazily drop already processed items when resuming and apply the limit."""
+    # Filter out already processed items if resuming, in the same pass as loading
+    if resume and processed_set:
+        logger.info(f"Resuming from previous run. {len(processed_set)} items already processed.")
+        data = (item for item in data if item["qid"] not in processed_set)
     
     # Apply limit if specified
     if limit is not None:
-        data_to_process = data_to_process[:limit]
+        data = islice(data, limit)
+    
+    return data
+
+def start_writer(processed_ids: List[str], processed_set: Set[str], counts: Dict[str, int]) -> threading.Thread:
+    """Start the background thread that owns the results file, the progress list and the counts."""
+    global RESULTS_FH
+    # Opened only once a test actually runs, so --test-connection leaves no empty results file;
+    # one buffered handle is kept for the whole run instead of reopening per result
+    RESULTS_FH = open(RESULTS_FILE, 'ab', buffering=1 << 20)
+    writer = threading.Thread(target=result_writer, args=(processed_ids, processed_set, counts), daemon=True)
+    writer.start()
+    return writer
+
+def stop_writer(writer: threading.Thread) -> None:
+    """Signal the background writer to finish, wait for its final progress flush and close the results file."""
+    WRITE_QUEUE.put(None)
+    writer.join()
+    RESULTS_FH.close()
+
+def run_test(data: Iterable[Dict[str, Any]], limit: Optional[int] = None, resume: bool = False,
+             workers: int = 1, batch_size: int = 1) -> Dict[str, Any]:
+    """Run the test on the provided data, querying the API with a pool of worker threads.
+    
+    With batch_size > 1 each request carries that many prompts, for servers
+    that accept a list of prompts and batch them internally. Returns the
+    accuracy summary for the items processed in this run.
+    """
+    processed_ids = load_progress() if resume else []
+    processed_set = set(processed_ids)
+    data = select_items(data, processed_set, limit=limit, resume=resume)
+    
+    counts = new_counts()
     
-    logger.info(f"Processing {len(data_to_process)} items...")
+    # A single writer thread owns the results file, the progress list and the
+    # counts, so workers go straight back to the network instead of waiting on disk
+    writer = start_writer(processed_ids, processed_set, counts)
     
-    for item in tqdm(data_to_process, desc="Testing agir emotion master"):
-        prompt = create_prompt(item)
-        api_response = query_agir_api(prompt)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_batch, batch): len(batch) for batch in iter_batches(data, batch_size)}
+            total = sum(futures.values())
+            logger.info(f"Processing {total} items with {workers} worker(s), batch size {batch_size}...")
+            
+            try:
+                with tqdm(total=total, desc="Testing agir emotion master", **progress_bar_options(total)) as progress:
+                    for future in as_completed(futures):
+                        future.result()
+                        progress.update(futures[future])
+            except BaseException:
+                # Don't start queued batches after a fatal error (e.g. retries exhausted) or Ctrl+C
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        stop_writer(writer)
+    
+    # EN and ZH items share qids, so the saved results, not the unique qids, count the items
+    logger.info(f"Testing complete. Saved {counts['total']} results ({len(processed_ids)} unique qids processed in total).")
+    return summarize_counts(counts)
+
+async def query_agir_api_async(client: httpx.AsyncClient, prompt: str, retries: int = 3,
+                               retry_delay: int = 5) -> Optional[Dict[str, Any]]:
+    """Async counterpart of query_agir_api using a shared httpx.AsyncClient."""
+    payload = PAYLOAD_TEMPLATE | {"prompt": prompt}
+    
+    for attempt in range(retries):
+        try:
+            response = await client.post("/completions", json=payload)
+            
+            if response.status_code != 200:
+                logger.error(f"API request failed with status {response.status_code}")
+                logger.error(f"Response text: {response.text}")
+            else:
+                try:
+                    response_data = json_loads(response.content)
+                except json.JSONDecodeError as je:
+                    logger.error(f"Failed to parse response as JSON: {je}")
+                    logger.error(f"Raw response text: {repr(response.text)}")
+                    response_data = {}
+                
+                if response_data.get("choices"):
+                    text_content = response_data["choices"][0].get("text", "")
+                    if not text_content.strip():
+                        logger.error("Received empty text content from API")
+                    else:
+                        try:
+                            return extract_answer(text_content)
+                        except json.JSONDecodeError as je:
+                            logger.error(f"JSON decode error: {je}")
+                            logger.error(f"Content that failed to parse: {repr(text_content)}")
+                else:
+                    logger.error("No choices in API response")
+                    logger.error(f"Full response structure: {response_data}")
+                    
+        except httpx.TimeoutException as e:
+            logger.error(f"Request timeout after 120 seconds (attempt {attempt+1}/{retries}): {str(e)}")
+        except httpx.HTTPError as e:
+            logger.error(f"Request error (attempt {attempt+1}/{retries}): {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error (attempt {attempt+1}/{retries}): {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+        
+        if attempt < retries - 1:
+            delay = backoff_delay(attempt, retry_delay)
+            logger.info(f"Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+    
+    logger.error("Max retries reached. Exiting.")
+    sys.exit(1)
+
+async def run_test_async(data: Iterable[Dict[str, Any]], limit: Optional[int] = None, resume: bool = False,
+                         workers: int = 1) -> Dict[str, Any]:
+    """Run the test with asyncio, keeping at most `workers` requests in flight on one thread.
+    
+    Returns the accuracy summary for the items processed in this run.
+    """
+    processed_ids = load_progress() if resume else []
+    processed_set = set(processed_ids)
+    data = select_items(data, processed_set, limit=limit, resume=resume)
+    
+    counts = new_counts()
+    writer = start_writer(processed_ids, processed_set, counts)
+    semaphore = asyncio.Semaphore(workers)
+    
+    async def process_item_async(client: httpx.AsyncClient, item: Dict[str, Any]) -> None:
+        async with semaphore:
+            api_response = await query_agir_api_async(client, create_prompt(item))
         
         if api_response:
-            result = evaluate_responses(api_response, item)
-            save_result(result)
-            processed_ids.append(item["qid"])
-            save_progress(processed_ids)
+            WRITE_QUEUE.put((evaluate_responses(api_response, item), item["qid"]))
         else:
             logger.warning(f"Skipping item {item['qid']} due to failed API query.")
     
-    logger.info(f"Testing complete. Processed {len(processed_ids)} items in total.")
+    try:
+        async with httpx.AsyncClient(base_url=API_BASE_URL, http2=HTTP2_AVAILABLE, timeout=120,
+                                     headers=REQUEST_HEADERS,
+                                     limits=httpx.Limits(max_connections=workers)) as client:
+            tasks = [asyncio.ensure_future(process_item_async(client, item)) for item in data]
+            logger.info(f"Processing {len(tasks)} items with up to {workers} concurrent request(s)...")
+            
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Testing agir emotion master",
+                             **progress_bar_options(len(tasks))):
+                await task
+    finally:
+        stop_writer(writer)
+    
+    logger.info(f"Testing complete. Saved {counts['total']} results ({len(processed_ids)} unique qids processed in total).")
+    return summarize_counts(counts)
 
 def calculate_statistics() -> Dict[str, Any]:
-    """Calculate statistics from the results file."""
-    if not RESULTS_FILE or not Path(RESULTS_FILE).exists():
+    """Calculate statistics from the results file.
+    
+    run_test already returns the summary for the current run; this re-reads
+    the whole file, which is only needed when earlier runs contributed to it.
+    """
+    if not RESULTS_FILE or not os.path.exists(RESULTS_FILE):
         return {"error": "No results file found"}
     
-    results = []
-    with open(RESULTS_FILE, 'r', encoding='utf-8') as f:
+    # Stream the file once, accumulating all counters in a single pass
+    counts = new_counts()
+    with open(RESULTS_FILE, 'rb') as f:
         for line in f:
-            results.append(json.loads(line))
-    
-    total = len(results)
-    emotion_correct = sum(1 for r in results if r["emotion_correct"])
-    cause_correct = sum(1 for r in results if r["cause_correct"])
-    both_correct = sum(1 for r in results if r["both_correct"])
+            r = json_loads(line)
+            counts["total"] += 1
+            counts["emotion_correct"] += r["emotion_correct"]
+            counts["cause_correct"] += r["cause_correct"]
+            counts["both_correct"] += r["both_correct"]
     
-    return {
-        "total_items": total,
-        "emotion_accuracy": emotion_correct / total if total > 0 else 0,
-        "cause_accuracy": cause_correct / total if total > 0 else 0,
-        "both_correct_accuracy": both_correct / total if total > 0 else 0
-    }
+    return summarize_counts(counts)
 
 def test_api_connection() -> bool:
     """Test if the API is accessible."""
@@ -380,13 +720,12 @@ def test_api_connection() -> bool:
         url = f"{API_BASE_URL}/completions"
         
         logger.info(f"Test URL: {url}")
-        logger.info(f"Test Payload: {json.dumps(test_payload, indent=2, ensure_ascii=False)}")
+        logger.info(f"Test Payload: {format_json(test_payload)}")
         
-        import time
         start_time = time.time()
         logger.info(f"Starting connection test at {time.strftime('%Y-%m-%d %H:%M:%S')}")
         
-        response = requests.post(url, json=test_payload, timeout=120)
+        response = SESSION.post(url, json=test_payload, timeout=120)
         
         end_time = time.time()
         duration = end_time - start_time
@@ -398,7 +737,7 @@ def test_api_connection() -> bool:
             logger.info("API connection successful")
             try:
                 response_data = response.json()
-                logger.info(f"Test response data: {json.dumps(response_data, indent=2, ensure_ascii=False)}")
+                logger.info(f"Test response data: {format_json(response_data)}")
             except json.JSONDecodeError as je:
                 logger.warning(f"Could not parse test response as JSON: {je}")
                 logger.warning(f"Raw test response: {repr(response.text)}")
@@ -417,18 +756,30 @@ def test_api_connection() -> bool:
     except Exception as e:
         logger.error(f"API connection test failed: {str(e)}")
         logger.error(f"Error type: {type(e).__name__}")
-        import traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
         return False
 
+def positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def main():
     """Main function to run the test."""
     parser = argparse.ArgumentParser(description="Test agir emotion master API on EU.jsonl")
     parser.add_argument("--limit", type=int, help="Limit the number of records to test")
     parser.add_argument("--resume", action="store_true", help="Resume from previous run")
     parser.add_argument("--test-connection", action="store_true", help="Only test API connection")
+    parser.add_argument("--workers", type=positive_int, default=1, help="Number of concurrent API requests")
+    parser.add_argument("--batch-size", type=positive_int, default=1,
+                        help="Number of prompts sent per API request (thread pool mode only)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Use a single-threaded asyncio/httpx client instead of a thread pool")
     args = parser.parse_args()
     
+    load_env()
     setup_directories()
     
     # Test API connection first
@@ -443,19 +794,25 @@ def main():
     #     logger.error("Cannot connect to agir emotion master API. Please ensure the service is running at http://localhost:8000")
     #     return
     
-    # Load data
-    try:
-        data = load_data(INPUT_FILE)
-        logger.info(f"Loaded {len(data)} records from {INPUT_FILE}")
-    except Exception as e:
-        logger.error(f"Error loading data: {str(e)}")
+    # Records are streamed from the input file while the test runs
+    if not Path(INPUT_FILE).exists():
+        logger.error(f"Error loading data: input file {INPUT_FILE} not found")
         return
+    logger.info(f"Streaming records from {INPUT_FILE}")
     
     # Run test
-    run_test(data, limit=args.limit, resume=args.resume)
+    if args.use_async:
+        stats = asyncio.run(run_test_async(iter_data(INPUT_FILE), limit=args.limit, resume=args.resume,
+                                           workers=args.workers))
+    else:
+        stats = run_test(iter_data(INPUT_FILE), limit=args.limit, resume=args.resume, workers=args.workers,
+                         batch_size=args.batch_size)
+    
+    # A resumed run only counted its own items, so re-read the full results file
+    if args.resume:
+        stats = calculate_statistics()
     
-    # Calculate and display statistics
-    stats = calculate_statistics()
+    # Display statistics
     logger.info(f"Results summary for agir emotion master:")
     for key, value in stats.items():
         if isinstance(value, float):
@@ -464,4 +821,4 @@ def main():
             logger.info(f"{key}: {value}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main() 
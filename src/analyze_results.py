@@ -2,16 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import os
+import csv
 import json
+import functools
 import argparse
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import matplotlib as mpl
+mpl.use('Agg')  # Files only; skip GUI backend initialisation
+import matplotlib.pyplot as plt
+from matplotlib import font_manager
 import seaborn as sns
 from pathlib import Path
 import logging
 from dotenv import load_dotenv
 import platform
+from collections import Counter
+
+# orjson is much faster than the stdlib json module but optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(
@@ -20,73 +32,112 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Confusion matrix heatmaps: annotate cells only up to this many labels, and
+# switch from seaborn to a plain imshow beyond the second threshold
+HEATMAP_ANNOTATE_MAX_LABELS = 20
+HEATMAP_IMSHOW_MAX_LABELS = 50
+
+# Sidecar in each model's output directory recording which results.jsonl the outputs were built from
+CACHE_META_FILE = ".cache_meta.json"
+
+# Candidate CJK font families per platform, in order of preference
+CJK_FONT_CANDIDATES = {
+    'Darwin': ['Arial Unicode MS'],
+    'Windows': ['Microsoft YaHei'],
+    'Linux': ['Noto Sans CJK JP', 'Noto Sans CJK SC', 'WenQuanYi Micro Hei'],
+}
+
+@functools.lru_cache(maxsize=1)
+def detect_cjk_family():
+    """Return the first installed CJK font family for this platform, or None.
+    
+    findfont is called without the default fallback so a missing font actually
+    raises instead of silently resolving to DejaVu Sans. The result is cached
+    because scanning the font list is comparatively slow.
+    """
+    for family in CJK_FONT_CANDIDATES.get(platform.system(), []):
+        try:
+            font_manager.findfont(font_manager.FontProperties(family=family), fallback_to_default=False)
+            return family
+        except ValueError:
+            continue
+    return None
+
 # Configure matplotlib font for CJK characters
 def configure_fonts():
     """Configure matplotlib to use appropriate fonts for CJK characters."""
-    system = platform.system()
-    
-    if system == 'Darwin':  # macOS
-        mpl.rc('font', family='Arial Unicode MS')
-    elif system == 'Windows':
-        mpl.rc('font', family='Microsoft YaHei')
-    elif system == 'Linux':
-        # Try common CJK fonts available on Linux
-        for font in ['Noto Sans CJK JP', 'Noto Sans CJK SC', 'WenQuanYi Micro Hei']:
-            try:
-                mpl.rc('font', family=font)
-                logger.info(f"Using font: {font}")
-                break
-            except:
-                continue
+    family = detect_cjk_family()
+    if family:
+        mpl.rcParams['font.family'] = family
+        logger.info(f"Using font: {family}")
+    else:
+        logger.info("No CJK font found; CJK labels may not render correctly")
     
     # Fallback to non-CJK handling if we can't find a good font
     mpl.rcParams['axes.unicode_minus'] = False  # Fix minus sign display issue
 
+def json_loads(data):
+    """Parse JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def iter_results(results_file):
+    """Stream results from a JSONL file one row at a time."""
+    with open(results_file, 'rb', buffering=1 << 20) as f:
+        for line in f:
+            yield json_loads(line)
+
 def load_results(results_file):
     """Load results from JSONL file."""
-    data = []
-    with open(results_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            data.append(json.loads(line))
-    return data
+    return list(iter_results(results_file))
 
-def calculate_metrics(results):
-    """Calculate metrics from the results."""
-    total = len(results)
-    emotion_correct = sum(1 for r in results if r["emotion_correct"])
-    cause_correct = sum(1 for r in results if r["cause_correct"])
-    both_correct = sum(1 for r in results if r["both_correct"])
+def calculate_metrics(df):
+    """Calculate metrics from the results DataFrame."""
+    total = len(df)
+    if total == 0:
+        accuracy = {"emotion_correct": 0, "cause_correct": 0, "both_correct": 0}
+    else:
+        accuracy = df[["emotion_correct", "cause_correct", "both_correct"]].mean()
     
     metrics = {
         "total_items": total,
-        "emotion_accuracy": emotion_correct / total if total > 0 else 0,
-        "cause_accuracy": cause_correct / total if total > 0 else 0,
-        "both_correct_accuracy": both_correct / total if total > 0 else 0
+        "emotion_accuracy": float(accuracy["emotion_correct"]),
+        "cause_accuracy": float(accuracy["cause_correct"]),
+        "both_correct_accuracy": float(accuracy["both_correct"])
     }
     
     return metrics
 
-def create_confusion_matrix(results):
+def add_first_emotion_columns(df):
+    """Add true_first/predicted_first columns holding the first emotion of each label.
+    
+    Labels may combine emotions ("Joy & Pride"); only the first is used for
+    simplicity. Splitting once here saves every downstream pass from re-splitting.
+    """
+    if not df.empty:
+        df["true_first"] = df["true_emotion"].str.split(" & ", n=1).str[0]
+        df["predicted_first"] = df["predicted_emotion"].str.split(" & ", n=1).str[0]
+    return df
+
+def create_confusion_matrix(df):
     """Create a confusion matrix for emotion prediction."""
-    # Extract unique emotions
-    all_emotions = set()
-    for r in results:
-        true_emotion = r["true_emotion"].split(" & ")[0]  # Just use first emotion for simplicity
-        pred_emotion = r["predicted_emotion"].split(" & ")[0]  # Just use first emotion for simplicity
-        all_emotions.add(true_emotion)
-        all_emotions.add(pred_emotion)
+    if df.empty:
+        return pd.DataFrame(dtype=int)
     
-    all_emotions = sorted(list(all_emotions))
+    true_emotion = df["true_first"]
+    pred_emotion = df["predicted_first"]
     
-    # Create the confusion matrix
-    confusion = pd.DataFrame(0, index=all_emotions, columns=all_emotions)
+    # Square matrix over every label seen on either axis
+    all_emotions = sorted(set(true_emotion) | set(pred_emotion))
+    n_labels = len(all_emotions)
     
-    for r in results:
-        true_emotion = r["true_emotion"].split(" & ")[0]
-        pred_emotion = r["predicted_emotion"].split(" & ")[0]
-        confusion.loc[true_emotion, pred_emotion] += 1
+    # Integer-code both columns against the shared label order and count (true, predicted) pairs in one pass
+    true_codes = pd.Categorical(true_emotion, categories=all_emotions).codes.astype(np.int64)
+    pred_codes = pd.Categorical(pred_emotion, categories=all_emotions).codes.astype(np.int64)
+    counts = np.bincount(true_codes * n_labels + pred_codes, minlength=n_labels * n_labels)
     
-    return confusion
+    return pd.DataFrame(counts.reshape(n_labels, n_labels), index=all_emotions, columns=all_emotions)
 
 def analyze_model_results(model_dir):
     """Analyze results for a specific model."""
@@ -99,58 +150,115 @@ def analyze_model_results(model_dir):
     results = load_results(results_file)
     logger.info(f"Loaded {len(results)} results from {results_file}")
     
-    # Calculate basic metrics
-    metrics = calculate_metrics(results)
-    
-    # Create a DataFrame for easier analysis
-    df = pd.DataFrame(results)
+    # Build the DataFrame once; metrics and confusion matrix are computed from it
+    df = add_first_emotion_columns(pd.DataFrame(results))
     
     return {
         "model_name": model_dir,
-        "metrics": metrics,
+        "metrics": calculate_metrics(df),
         "dataframe": df,
-        "confusion_matrix": create_confusion_matrix(results)
+        "confusion_matrix": create_confusion_matrix(df)
     }
 
-def plot_confusion_matrix(confusion_matrix, model_name, output_dir):
-    """Plot and save confusion matrix heatmap."""
-    plt.figure(figsize=(12, 10))
-    sns.heatmap(confusion_matrix, annot=True, fmt='d', cmap='Blues')
-    plt.title(f'Emotion Confusion Matrix - {model_name}')
-    plt.ylabel('True Emotion')
-    plt.xlabel('Predicted Emotion')
-    plt.tight_layout()
+def results_cache_key(results_file):
+    """Identify a results file version by its modification time and size."""
+    stat = os.stat(results_file)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+def load_cached_metrics(results_file, output_dir):
+    """Return the saved metrics if output_dir was built from the current results file and is intact, else None."""
+    meta_path = os.path.join(output_dir, CACHE_META_FILE)
+    metrics_path = os.path.join(output_dir, "metrics.json")
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("results") != results_cache_key(results_file):
+            return None
+        # A deleted plot or CSV has to be rebuilt even though the results are unchanged
+        if not all(os.path.exists(os.path.join(output_dir, name)) for name in meta.get("outputs", [])):
+            return None
+        with open(metrics_path) as f:
+            return json.load(f)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def save_cache_meta(output_dir, key):
+    """Record the results file version the outputs in output_dir were built from, and those outputs."""
+    outputs = sorted(name for name in os.listdir(output_dir) if name != CACHE_META_FILE)
+    with open(os.path.join(output_dir, CACHE_META_FILE), 'w') as f:
+        json.dump({"results": key, "outputs": outputs}, f)
+
+def create_confusion_matrix_axes():
+    """Create a confusion matrix figure with a dedicated colorbar axis."""
+    fig, (ax, cbar_ax) = plt.subplots(1, 2, figsize=(12, 10), gridspec_kw={'width_ratios': [20, 1]})
+    return ax, cbar_ax
+
+def reuse_axes(ax, figsize):
+    """Return (fig, ax, owned): a cleared reused ax, or a new figure the caller must close."""
+    if ax is None:
+        fig, ax = plt.subplots(figsize=figsize)
+        return fig, ax, True
+    ax.clear()
+    return ax.figure, ax, False
+
+def plot_confusion_matrix(confusion_matrix, model_name, output_dir, ax=None, cbar_ax=None):
+    """Plot and save confusion matrix heatmap.
+    
+    Pass ax/cbar_ax from create_confusion_matrix_axes to reuse one figure
+    across models; otherwise a new figure is created and closed.
+    """
+    owned = ax is None
+    if owned:
+        ax, cbar_ax = create_confusion_matrix_axes()
+    else:
+        ax.clear()
+        cbar_ax.clear()
+    fig = ax.figure
+    
+    n_labels = len(confusion_matrix)
+    if n_labels > HEATMAP_IMSHOW_MAX_LABELS:
+        # Very wide label sets: a plain raster image is much cheaper than seaborn's per-cell mesh
+        image = ax.imshow(confusion_matrix.values, cmap='Blues', interpolation='nearest', aspect='auto')
+        fig.colorbar(image, cax=cbar_ax)
+        ax.set_xticks(range(n_labels), confusion_matrix.columns, rotation=90, fontsize=6)
+        ax.set_yticks(range(n_labels), confusion_matrix.index, fontsize=6)
+    else:
+        # Per-cell count labels are only readable (and worth their render cost) on small matrices
+        sns.heatmap(confusion_matrix, annot=n_labels <= HEATMAP_ANNOTATE_MAX_LABELS, fmt='d',
+                    cmap='Blues', rasterized=True, ax=ax, cbar_ax=cbar_ax)
+    ax.set_title(f'Emotion Confusion Matrix - {model_name}')
+    ax.set_ylabel('True Emotion')
+    ax.set_xlabel('Predicted Emotion')
+    fig.tight_layout()
     
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, f"{model_name}_confusion_matrix.png")
-    plt.savefig(output_path)
-    plt.close()
+    fig.savefig(output_path)
+    if owned:
+        plt.close(fig)
     logger.info(f"Saved confusion matrix to {output_path}")
 
-def plot_accuracy_metrics(metrics, model_name, output_dir):
+def plot_accuracy_metrics(metrics, model_name, output_dir, ax=None):
     """Plot and save accuracy metrics."""
     metrics_to_plot = {k: v for k, v in metrics.items() if k != 'total_items'}
     
-    plt.figure(figsize=(10, 6))
-    bars = plt.bar(metrics_to_plot.keys(), metrics_to_plot.values(), color=['blue', 'green', 'red'])
+    fig, ax, owned = reuse_axes(ax, figsize=(10, 6))
+    bars = ax.bar(metrics_to_plot.keys(), metrics_to_plot.values(), color=['blue', 'green', 'red'])
     
     # Add percentage labels on top of bars
     for bar in bars:
         height = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width()/2., height + 0.01,
-                 f'{height:.1%}', ha='center', va='bottom')
+        ax.text(bar.get_x() + bar.get_width()/2., height + 0.01,
+                f'{height:.1%}', ha='center', va='bottom')
     
-    plt.title(f'Accuracy Metrics - {model_name}')
-    plt.ylim(0, 1)
-    plt.ylabel('Accuracy')
-    plt.tight_layout()
+    ax.set_title(f'Accuracy Metrics - {model_name}')
+    ax.set_ylim(0, 1)
+    ax.set_ylabel('Accuracy')
+    fig.tight_layout()
     
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, f"{model_name}_accuracy_metrics.png")
-    plt.savefig(output_path)
-    plt.close()
+    fig.savefig(output_path)
+    if owned:
+        plt.close(fig)
     logger.info(f"Saved accuracy metrics to {output_path}")
 
 def compare_models(models_results, output_dir):
@@ -171,13 +279,13 @@ def compare_models(models_results, output_dir):
         cause_accuracy.append(result["metrics"]["cause_accuracy"])
         both_accuracy.append(result["metrics"]["both_correct_accuracy"])
     
-    # Create a DataFrame for comparison
-    comparison_df = pd.DataFrame({
+    # Plain dict-of-lists table; one row per model is too small to need a DataFrame
+    comparison = {
         'Model': model_names,
         'Emotion Accuracy': emotion_accuracy,
         'Cause Accuracy': cause_accuracy,
         'Both Correct': both_accuracy
-    })
+    }
     
     # Plot comparison
     plt.figure(figsize=(12, 8))
@@ -196,8 +304,6 @@ def compare_models(models_results, output_dir):
     plt.legend()
     plt.tight_layout()
     
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, "model_comparison.png")
     plt.savefig(output_path)
     plt.close()
@@ -205,77 +311,60 @@ def compare_models(models_results, output_dir):
     
     # Save the comparison data
     comparison_csv = os.path.join(output_dir, "model_comparison.csv")
-    comparison_df.to_csv(comparison_csv, index=False)
+    with open(comparison_csv, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(comparison.keys())
+        writer.writerows(zip(*comparison.values()))
     logger.info(f"Saved model comparison data to {comparison_csv}")
     
-    return comparison_df
+    return comparison
 
-def analyze_misclassifications(results):
-    """Analyze common misclassifications of emotions."""
-    misclassifications = []
-    
-    for result in results:
-        if not result["emotion_correct"]:
-            true_emotion = result["true_emotion"].split(" & ")[0]  # Use first emotion for simplicity
-            pred_emotion = result["predicted_emotion"].split(" & ")[0]
-            
-            misclassifications.append({
-                "true_emotion": true_emotion,
-                "predicted_emotion": pred_emotion,
-                "scenario": result["scenario"],
-                "subject": result["subject"],
-                "qid": result["qid"]
-            })
-    
-    return misclassifications
+def analyze_misclassifications(df):
+    """Analyze common misclassifications of emotions, returning one row per misclassified item."""
+    columns = ["true_emotion", "predicted_emotion", "scenario", "subject", "qid"]
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    
+    misclassified = df.loc[~df["emotion_correct"].astype(bool),
+                           ["true_first", "predicted_first", "scenario", "subject", "qid"]]
+    misclassified.columns = columns
+    return misclassified.reset_index(drop=True)
 
-def plot_top_misclassifications(results, model_name, output_dir, top_n=10):
+def plot_top_misclassifications(df, model_name, output_dir, top_n=10, ax=None):
     """Plot the top N most common emotion misclassifications."""
-    misclass = analyze_misclassifications(results)
+    misclass = analyze_misclassifications(df)
     
-    if not misclass:
+    if misclass.empty:
         logger.info("No misclassifications found.")
         return
     
-    # Count misclassification pairs
-    misclass_counts = {}
-    for item in misclass:
-        key = f"{item['true_emotion']} → {item['predicted_emotion']}"
-        if key in misclass_counts:
-            misclass_counts[key] += 1
-        else:
-            misclass_counts[key] = 1
-    
-    # Sort by count (descending)
-    sorted_misclass = sorted(misclass_counts.items(), key=lambda x: x[1], reverse=True)
-    
-    # Take top N
-    top_misclass = sorted_misclass[:top_n]
+    # Count misclassification pairs, most common first; ties keep first-seen order
+    pair_counts = Counter(zip(misclass["true_emotion"], misclass["predicted_emotion"]))
+    top_misclass = pair_counts.most_common(top_n)
     
     # Prepare data for plotting
-    labels = [item[0] for item in top_misclass]
-    counts = [item[1] for item in top_misclass]
+    labels = [f"{true_emotion} → {pred_emotion}" for (true_emotion, pred_emotion), _ in top_misclass]
+    counts = [count for _, count in top_misclass]
     
     # Plot horizontal bar chart
-    plt.figure(figsize=(12, 8))
+    fig, ax, owned = reuse_axes(ax, figsize=(12, 8))
     y_pos = range(len(labels))
-    plt.barh(y_pos, counts, align='center')
-    plt.yticks(y_pos, labels)
-    plt.xlabel('Count')
-    plt.title(f'Top {top_n} Emotion Misclassifications - {model_name}')
-    plt.tight_layout()
+    ax.barh(y_pos, counts, align='center')
+    ax.set_yticks(y_pos, labels)
+    ax.set_xlabel('Count')
+    ax.set_title(f'Top {top_n} Emotion Misclassifications - {model_name}')
+    fig.tight_layout()
     
     # Save figure
-    os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, f"{model_name}_top_misclassifications.png")
-    plt.savefig(output_path)
-    plt.close()
+    fig.savefig(output_path)
+    if owned:
+        plt.close(fig)
     logger.info(f"Saved top misclassifications to {output_path}")
     
     # Save misclassification details to CSV for further analysis
-    misclass_df = pd.DataFrame(misclass)
     csv_path = os.path.join(output_dir, f"{model_name}_misclassifications.csv")
-    misclass_df.to_csv(csv_path, index=False)
+    misclass.to_csv(csv_path, index=False)
     logger.info(f"Saved misclassification details to {csv_path}")
 
 def main():
@@ -283,6 +372,8 @@ def main():
     parser.add_argument("--model", help="Specific model directory to analyze (e.g., gpt-4-1-nano)")
     parser.add_argument("--compare", action="store_true", help="Compare all available models")
     parser.add_argument("--output_dir", default="results/analysis", help="Directory to save analysis results")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-analyze models even if their results.jsonl is unchanged since the last run")
     args = parser.parse_args()
     
     # Configure fonts for CJK characters
@@ -303,22 +394,42 @@ def main():
     
     logger.info(f"Analyzing models: {', '.join(model_dirs)}")
     
+    # One figure per plot type, cleared and redrawn for each model
+    cm_ax, cm_cbar_ax = create_confusion_matrix_axes()
+    _, accuracy_ax = plt.subplots(figsize=(10, 6))
+    _, misclass_ax = plt.subplots(figsize=(12, 8))
+    
+    # Output directories are created here once; the plot functions expect them to exist
+    os.makedirs(args.output_dir, exist_ok=True)
+    
     # Process each model
     all_results = []
     for model_dir in model_dirs:
+        output_dir = os.path.join(args.output_dir, model_dir)
+        results_file = os.path.join("results", model_dir, "results.jsonl")
+        
+        # Outputs already built from this exact results file only need their metrics for the comparison
+        if not args.force and os.path.exists(results_file):
+            cached_metrics = load_cached_metrics(results_file, output_dir)
+            if cached_metrics is not None:
+                logger.info(f"Results for {model_dir} unchanged since last analysis; reusing {output_dir}")
+                all_results.append({"model_name": model_dir, "metrics": cached_metrics})
+                continue
+        
+        # Taken before loading so a file rewritten mid-analysis is picked up next time
+        cache_key = results_cache_key(results_file) if os.path.exists(results_file) else None
         result = analyze_model_results(model_dir)
         if result:
             all_results.append(result)
             
             # Create individual model visualizations
-            output_dir = os.path.join(args.output_dir, model_dir)
             os.makedirs(output_dir, exist_ok=True)
             
             # Plot confusion matrix
-            plot_confusion_matrix(result["confusion_matrix"], model_dir, output_dir)
+            plot_confusion_matrix(result["confusion_matrix"], model_dir, output_dir, ax=cm_ax, cbar_ax=cm_cbar_ax)
             
             # Plot accuracy metrics
-            plot_accuracy_metrics(result["metrics"], model_dir, output_dir)
+            plot_accuracy_metrics(result["metrics"], model_dir, output_dir, ax=accuracy_ax)
             
             # Save metrics as JSON
             metrics_json_path = os.path.join(output_dir, "metrics.json")
@@ -327,14 +438,18 @@ def main():
             logger.info(f"Saved metrics to {metrics_json_path}")
             
             # Plot top misclassifications
-            plot_top_misclassifications(result["dataframe"].to_dict('records'), model_dir, output_dir)
+            plot_top_misclassifications(result["dataframe"], model_dir, output_dir, ax=misclass_ax)
+            
+            save_cache_meta(output_dir, cache_key)
+    
+    plt.close('all')
     
     # Compare models if requested or if multiple models are being analyzed
     if args.compare or len(all_results) > 1:
         comparison = compare_models(all_results, args.output_dir)
         if comparison is not None:
             logger.info("\nModel Comparison Summary:")
-            print(comparison.to_string(index=False))
+            print(pd.DataFrame(comparison).to_string(index=False))
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -4,8 +4,18 @@
 import os
 import sys
 import json
+import functools
 from dotenv import load_dotenv
 
+@functools.lru_cache(maxsize=1)
+def load_env():
+    """Load .env once and return the settings this tool reports on"""
+    load_dotenv()
+    return {
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY"),
+        "GPT_MODEL": os.environ.get("GPT_MODEL"),
+    }
+
 def main():
     """Check environment configuration and provide diagnostic information"""
     print("Environment Check Tool")
@@ -15,8 +25,8 @@ def main():
     print(f"Python version: {sys.version}")
     
     # Check OPENAI_API_KEY
-    load_dotenv()
-    api_key = os.getenv("OPENAI_API_KEY")
+    env = load_env()
+    api_key = env["OPENAI_API_KEY"]
     if api_key:
         masked_key = api_key[:5] + "*" * (len(api_key) - 9) + api_key[-4:]
         print(f"OPENAI_API_KEY: {masked_key} (valid)")
@@ -24,7 +34,7 @@ def main():
         print("OPENAI_API_KEY: not set (please configure in .env file)")
     
     # Check GPT model configuration
-    gpt_model = os.getenv("GPT_MODEL")
+    gpt_model = env["GPT_MODEL"]
     if gpt_model:
         print(f"GPT_MODEL: {gpt_model}")
     else:
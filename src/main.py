@@ -6,20 +6,62 @@ import json
 import argparse
 import time
 import sys
+import hashlib
+import sqlite3
+import threading
+import functools
+import asyncio
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Iterator, BinaryIO, Set
+from itertools import islice
+from collections import defaultdict
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, AuthenticationError, RateLimitError, DefaultAsyncHttpxClient, Timeout
 from tqdm import tqdm
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# orjson is much faster than the stdlib json module but optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# HTTP/2 multiplexing in httpx needs the optional h2 package
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# tiktoken gives exact prompt token counts for the rate limiter; without it tokens are estimated from length
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# uvloop schedules --async requests faster than the default event loop; it is not available on Windows
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Configure logging; records are queued and written by a listener thread so workers never block on stderr
+LOG_QUEUE = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+LOG_LISTENER = QueueListener(LOG_QUEUE, _log_handler)
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(LOG_QUEUE)])
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
 logger = logging.getLogger(__name__)
 
 # Load environment variables
@@ -45,7 +87,69 @@ RESULTS_DIR = "results"
 MODEL_DIR = MODEL_NAME.replace(".", "-")
 MODEL_RESULTS_DIR = f"{RESULTS_DIR}/{MODEL_DIR}"
 PROGRESS_FILE = f"{MODEL_RESULTS_DIR}/progress.json"
+# Items that got no usable answer, one JSON line each, for inspection or a targeted re-run
+FAILURES_FILE = f"{MODEL_RESULTS_DIR}/failures.jsonl"
+FAILURES_LOCK = threading.Lock()
+# Last error per prompt whose retries ran out, picked up when its items are recorded as failures
+QUERY_ERRORS: Dict[str, str] = {}
+# Append-only qid log written during a run and folded into PROGRESS_FILE when the run ends
+PROGRESS_LOG = f"{MODEL_RESULTS_DIR}/progress.log"
 RESULTS_FILE = f"{MODEL_RESULTS_DIR}/results.jsonl"
+# Flush the results file and progress log to disk after this many newly saved results
+PROGRESS_FLUSH_INTERVAL = 20
+# Fixed lead-in shared by every prompt; OpenAI's prompt cache matches on exact prefixes
+PROMPT_INSTRUCTIONS = """Given the scenario below, identify the emotion of the subject and the cause of that emotion.
+
+Provide your answer in JSON format with two fields: "emotion" and "cause".
+"""
+# Per-item part of every prompt; static instructions come first and the scenario last,
+# so requests share the longest possible prefix
+QUESTION_TEMPLATE = """Emotion choices: {emotion_choices}
+
+Cause choices: {cause_choices}
+
+Scenario: {scenario}
+
+Subject: {subject}
+"""
+PROMPT_TEMPLATE = PROMPT_INSTRUCTIONS + "\n" + QUESTION_TEMPLATE
+# Lead-in for --items-per-request prompts that ask several numbered questions at once
+MULTI_PROMPT_INSTRUCTIONS = """For each numbered scenario below, identify the emotion of the subject and the cause of that emotion, choosing from that scenario's own choices.
+
+Provide your answer as a JSON object keyed by scenario number, where each value has two fields: "emotion" and "cause".
+"""
+# Pulls the qid out of a raw input line so finished items can be skipped without a full parse
+QID_PATTERN = re.compile(rb'"qid"\s*:\s*"([^"]*)"')
+# The three correctness flags of a results line, for counting them without a full JSON parse
+CORRECT_FLAGS_PATTERN = re.compile(rb'"emotion_correct":\s*(true|false).*?"cause_correct":\s*(true|false)'
+                                   rb'.*?"both_correct":\s*(true|false)')
+# Cap on the exponential retry backoff, in seconds
+MAX_RETRY_DELAY = 60
+# Token cap for schema-constrained answers; the longest cause choice is ~50 tokens
+STRUCTURED_MAX_TOKENS = 150
+# Batch API (--batch) request/response files and status polling
+BATCH_INPUT_FILE = f"{MODEL_RESULTS_DIR}/batch_input.jsonl"
+BATCH_OUTPUT_FILE = f"{MODEL_RESULTS_DIR}/batch_output.jsonl"
+BATCH_ERROR_FILE = f"{MODEL_RESULTS_DIR}/batch_errors.jsonl"
+# Id and items of a submitted batch job whose results are not recorded yet, so an interrupted
+# --batch run collects that job instead of submitting (and paying for) it again
+BATCH_STATE_FILE = f"{MODEL_RESULTS_DIR}/batch_state.json"
+BATCH_POLL_INTERVAL = 60
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# Persistent prompt -> response cache so re-runs don't repeat identical API calls
+CACHE_DIR = "cache"
+CACHE_FILE = f"{CACHE_DIR}/{MODEL_DIR}.sqlite"
+
+# Set up in main() from the --no-cache / --replay-only flags
+CACHE_CONN = None
+CACHE_LOCK = threading.Lock()
+REPLAY_ONLY = False
+
+# Token-bucket rate limiter, configured in main() from --max-requests-per-minute / --max-tokens-per-minute
+MAX_REQUESTS_PER_MINUTE = None
+MAX_TOKENS_PER_MINUTE = None
+RATE_LOCK = threading.Lock()
+RATE_STATE = {"requests": 0.0, "tokens": 0.0, "updated": 0.0}
 
 def setup_directories() -> None:
     """Create necessary directories if they don't exist."""
@@ -53,159 +157,502 @@ def setup_directories() -> None:
     Path(MODEL_RESULTS_DIR).mkdir(exist_ok=True)
     logger.info(f"Results will be stored in: {MODEL_RESULTS_DIR}")
 
-def load_data(file_path: str) -> List[Dict[str, Any]]:
-    """Load data from JSONL file."""
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as f:
+def open_cache() -> None:
+    """Open (creating if needed) the SQLite response cache shared by all worker threads."""
+    global CACHE_CONN
+    Path(CACHE_DIR).mkdir(exist_ok=True)
+    CACHE_CONN = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+    # WAL keeps the per-response commits cheap and lets readers proceed during a write
+    CACHE_CONN.execute("PRAGMA journal_mode=WAL")
+    CACHE_CONN.execute("PRAGMA synchronous=NORMAL")
+    CACHE_CONN.execute("CREATE TABLE IF NOT EXISTS responses (hash TEXT PRIMARY KEY, response TEXT)")
+    CACHE_CONN.commit()
+    logger.info(f"Using response cache: {CACHE_FILE}")
+
+def responses_are_deterministic() -> bool:
+    """Whether the configured model is queried at temperature 0, so its responses can be replayed."""
+    return build_request_params("", {}).get("temperature") == 0
+
+def cache_key(prompt: str, params: Dict[str, Any]) -> str:
+    """Key a cached response by model, prompt and the other request parameters.
+    
+    The parameters (response schema, token cap, temperature) are part of the key so a
+    response is never replayed for a request it wasn't generated for.
+    """
+    settings = json.dumps({name: value for name, value in params.items() if name != "messages"}, sort_keys=True)
+    return hashlib.sha256(f"{MODEL_NAME}\0{prompt}\0{settings}".encode('utf-8')).hexdigest()
+
+def item_cache_key(item: Dict[str, Any]) -> str:
+    """Cache key of the single-item request for an item, as sent by query_gpt and the Batch API."""
+    prompt = create_prompt(item)
+    return cache_key(prompt, build_request_params(prompt, item_response_format(item)))
+
+def cache_get(key: str) -> Optional[str]:
+    """Return the cached raw response for a key, or None on a miss or when caching is off."""
+    if CACHE_CONN is None:
+        return None
+    with CACHE_LOCK:
+        row = CACHE_CONN.execute("SELECT response FROM responses WHERE hash = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def cache_put(key: str, response: str) -> None:
+    """Store a raw model response in the cache."""
+    if CACHE_CONN is None:
+        return
+    with CACHE_LOCK:
+        CACHE_CONN.execute("INSERT OR IGNORE INTO responses (hash, response) VALUES (?, ?)", (key, response))
+        CACHE_CONN.commit()
+
+def configure_rate_limits(max_requests_per_minute: Optional[int], max_tokens_per_minute: Optional[int]) -> None:
+    """Set the per-minute limits and start with full buckets."""
+    global MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE
+    MAX_REQUESTS_PER_MINUTE = max_requests_per_minute
+    MAX_TOKENS_PER_MINUTE = max_tokens_per_minute
+    RATE_STATE.update(requests=max_requests_per_minute or 0, tokens=max_tokens_per_minute or 0,
+                      updated=time.monotonic())
+    if max_requests_per_minute or max_tokens_per_minute:
+        logger.info(f"Rate limits: {max_requests_per_minute or 'unlimited'} requests/min, "
+                    f"{max_tokens_per_minute or 'unlimited'} tokens/min")
+
+@functools.lru_cache(maxsize=1)
+def get_encoding() -> Any:
+    """Return the tiktoken encoding for the configured model, or None without tiktoken."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(MODEL_NAME)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+@functools.lru_cache(maxsize=1)
+def instruction_token_counts() -> Dict[str, int]:
+    """Token counts of the static prompt lead-ins, encoded once per run."""
+    encoding = get_encoding()
+    return {prefix: len(encoding.encode(prefix)) for prefix in (PROMPT_INSTRUCTIONS, MULTI_PROMPT_INSTRUCTIONS)}
+
+def count_prompt_tokens(prompt: str) -> int:
+    """Prompt tokens, encoding only the part after the shared instructions; may be off by one at the seam."""
+    encoding = get_encoding()
+    if encoding is None:
+        return len(prompt) // 4 + 1
+    for prefix, prefix_tokens in instruction_token_counts().items():
+        if prompt.startswith(prefix):
+            return prefix_tokens + len(encoding.encode(prompt[len(prefix):]))
+    return len(encoding.encode(prompt))
+
+def estimate_request_tokens(params: Dict[str, Any]) -> int:
+    """Tokens a request may consume: the prompt plus the completion token cap."""
+    prompt_tokens = count_prompt_tokens(params["messages"][0]["content"])
+    return prompt_tokens + params.get("max_tokens", params.get("max_completion_tokens", 0))
+
+def reserve_capacity(tokens: int) -> float:
+    """Take one request and `tokens` from the buckets if available; otherwise return seconds to wait."""
+    with RATE_LOCK:
+        now = time.monotonic()
+        elapsed = now - RATE_STATE["updated"]
+        RATE_STATE["updated"] = now
+        wait = 0.0
+        if MAX_REQUESTS_PER_MINUTE:
+            RATE_STATE["requests"] = min(MAX_REQUESTS_PER_MINUTE,
+                                         RATE_STATE["requests"] + elapsed * MAX_REQUESTS_PER_MINUTE / 60)
+            if RATE_STATE["requests"] < 1:
+                wait = max(wait, (1 - RATE_STATE["requests"]) * 60 / MAX_REQUESTS_PER_MINUTE)
+        if MAX_TOKENS_PER_MINUTE:
+            # A single request larger than the whole bucket only has to wait for a full bucket
+            tokens = min(tokens, MAX_TOKENS_PER_MINUTE)
+            RATE_STATE["tokens"] = min(MAX_TOKENS_PER_MINUTE,
+                                       RATE_STATE["tokens"] + elapsed * MAX_TOKENS_PER_MINUTE / 60)
+            if RATE_STATE["tokens"] < tokens:
+                wait = max(wait, (tokens - RATE_STATE["tokens"]) * 60 / MAX_TOKENS_PER_MINUTE)
+        if wait == 0.0:
+            RATE_STATE["requests"] -= 1
+            RATE_STATE["tokens"] -= tokens
+        return wait
+
+def wait_for_capacity(params: Dict[str, Any]) -> None:
+    """Block until the rate limiter admits this request."""
+    if not (MAX_REQUESTS_PER_MINUTE or MAX_TOKENS_PER_MINUTE):
+        return
+    tokens = estimate_request_tokens(params)
+    while (wait := reserve_capacity(tokens)) > 0:
+        time.sleep(wait)
+
+async def wait_for_capacity_async(params: Dict[str, Any]) -> None:
+    """Async counterpart of wait_for_capacity."""
+    if not (MAX_REQUESTS_PER_MINUTE or MAX_TOKENS_PER_MINUTE):
+        return
+    tokens = estimate_request_tokens(params)
+    while (wait := reserve_capacity(tokens)) > 0:
+        await asyncio.sleep(wait)
+
+def release_unused_tokens(params: Dict[str, Any], response: Any) -> None:
+    """Return the reserved but unused completion tokens of a finished request to the bucket."""
+    usage = getattr(response, "usage", None)
+    if not MAX_TOKENS_PER_MINUTE or usage is None:
+        return
+    reserved = params.get("max_tokens", params.get("max_completion_tokens", 0))
+    unused = reserved - (usage.completion_tokens or 0)
+    if unused > 0:
+        with RATE_LOCK:
+            RATE_STATE["tokens"] = min(MAX_TOKENS_PER_MINUTE, RATE_STATE["tokens"] + unused)
+
+def backoff_delay(attempt: int, retry_delay: float) -> float:
+    """Exponential backoff with jitter so concurrent workers don't retry in lockstep."""
+    return min(retry_delay * (2 ** attempt) + random.uniform(0, retry_delay), MAX_RETRY_DELAY)
+
+def json_loads(data: Any) -> Any:
+    """Parse JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj: Any) -> bytes:
+    """Serialize an object to UTF-8 encoded JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def iter_data(file_path: str, skip_qids: Optional[Set[str]] = None) -> Iterator[Dict[str, Any]]:
+    """Stream records from a JSONL file one at a time, dropping qids in skip_qids before parsing."""
+    with open(file_path, 'rb', buffering=1 << 20) as f:
         for line in f:
-            data.append(json.loads(line))
-    return data
+            if skip_qids:
+                match = QID_PATTERN.search(line)
+                if match and match.group(1).decode('utf-8') in skip_qids:
+                    continue
+            yield json_loads(line)
+
+def save_progress(processed_ids: List[str], results_fh: Optional[BinaryIO] = None) -> None:
+    """Snapshot progress to PROGRESS_FILE and clear the progress log it now covers.
+    
+    Buffered results are flushed first so they are never behind the progress.
+    """
+    if results_fh is not None:
+        results_fh.flush()
+    tmp_file = f"{PROGRESS_FILE}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(json_dumps({"processed_ids": processed_ids, "updated_at": datetime.now().isoformat()}))
+    os.replace(tmp_file, PROGRESS_FILE)
+    # A crash before this truncate only leaves qids that load_progress de-duplicates
+    open(PROGRESS_LOG, 'wb').close()
+
+def append_progress(progress_fh: BinaryIO, qid: str) -> None:
+    """Record a completed qid in the append-only progress log."""
+    progress_fh.write(f"{qid}\n".encode('utf-8'))
+
+def flush_progress(results_fh: BinaryIO, progress_fh: BinaryIO) -> None:
+    """Flush results before the progress log so the log never claims an unsaved result."""
+    results_fh.flush()
+    progress_fh.flush()
 
-def save_progress(processed_ids: List[str]) -> None:
-    """Save progress information."""
-    with open(PROGRESS_FILE, 'w', encoding='utf-8') as f:
-        json.dump({"processed_ids": processed_ids, "updated_at": datetime.now().isoformat()}, f)
+def record_failure(item: Dict[str, Any], error: Optional[str]) -> None:
+    """Append an item that could not be answered, and why, to the failures file."""
+    failure = {"qid": item["qid"], "language": item.get("language"), "scenario": item["scenario"],
+               "subject": item["subject"], "error": error, "failed_at": datetime.now().isoformat()}
+    with FAILURES_LOCK, open(FAILURES_FILE, 'ab') as f:
+        f.write(json_dumps(failure) + b'\n')
 
 def load_progress() -> List[str]:
-    """Load progress information if it exists."""
+    """Load the progress snapshot plus any qids logged after it, in completion order."""
+    processed_ids = []
     if Path(PROGRESS_FILE).exists():
-        with open(PROGRESS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f).get("processed_ids", [])
-    return []
+        with open(PROGRESS_FILE, 'rb') as f:
+            processed_ids = json_loads(f.read()).get("processed_ids", [])
+    if Path(PROGRESS_LOG).exists():
+        seen = set(processed_ids)
+        with open(PROGRESS_LOG, 'r', encoding='utf-8') as f:
+            for line in f:
+                qid = line.rstrip('\n')
+                if qid and qid not in seen:
+                    seen.add(qid)
+                    processed_ids.append(qid)
+    return processed_ids
 
-def save_result(result: Dict[str, Any]) -> None:
-    """Save a single result to the results file."""
-    with open(RESULTS_FILE, 'a', encoding='utf-8') as f:
-        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+def save_result(results_fh: BinaryIO, result: Dict[str, Any]) -> None:
+    """Append a single result to the open results file."""
+    results_fh.write(json_dumps(result) + b'\n')
+
+@functools.lru_cache(maxsize=1024)
+def join_choices(choices: tuple) -> str:
+    """Join a choice list for the prompt; many items share the same choices."""
+    return ", ".join(choices)
 
 def create_prompt(item: Dict[str, Any]) -> str:
     """Create a prompt for GPT based on the item."""
-    scenario = item["scenario"]
-    subject = item["subject"]
-    emotion_choices = item["emotion_choices"]
-    cause_choices = item["cause_choices"]
-    
-    prompt = f"""Given the following scenario, identify the emotion of the subject and the cause of that emotion.
+    return build_prompt(item["scenario"], item["subject"],
+                        tuple(item["emotion_choices"]), tuple(item["cause_choices"]))
 
-Scenario: {scenario}
-
-Subject: {subject}
+@functools.lru_cache(maxsize=8192)
+def build_prompt(scenario: str, subject: str, emotion_choices: tuple, cause_choices: tuple) -> str:
+    """Format the prompt text, memoized so duplicate items reuse the same string."""
+    return PROMPT_TEMPLATE.format(emotion_choices=join_choices(emotion_choices),
+                                  cause_choices=join_choices(cause_choices),
+                                  scenario=scenario, subject=subject)
 
-Emotion choices: {", ".join(emotion_choices)}
+@functools.lru_cache(maxsize=8192)
+def build_response_format(emotion_choices: tuple, cause_choices: tuple) -> Dict[str, Any]:
+    """Structured Outputs schema pinning emotion and cause to the item's choices."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "emotion_cause",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "emotion": {"type": "string", "enum": list(emotion_choices)},
+                    "cause": {"type": "string", "enum": list(cause_choices)}
+                },
+                "required": ["emotion", "cause"],
+                "additionalProperties": False
+            }
+        }
+    }
 
-Cause choices: {", ".join(cause_choices)}
+def item_response_format(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Structured Outputs schema for a single item."""
+    return build_response_format(tuple(item["emotion_choices"]), tuple(item["cause_choices"]))
 
-Provide your answer in JSON format with two fields: "emotion" and "cause".
-"""
-    return prompt
+def create_multi_prompt(items: List[Dict[str, Any]]) -> str:
+    """Ask for the answers to several items in one prompt, numbering them from 1."""
+    sections = [MULTI_PROMPT_INSTRUCTIONS]
+    for number, item in enumerate(items, 1):
+        sections.append(f"### {number}\n\n" + QUESTION_TEMPLATE.format(
+            emotion_choices=join_choices(tuple(item["emotion_choices"])),
+            cause_choices=join_choices(tuple(item["cause_choices"])),
+            scenario=item["scenario"], subject=item["subject"]))
+    return "\n".join(sections)
 
-def query_gpt(prompt: str, retries: int = 3, retry_delay: int = 5) -> Optional[Dict[str, Any]]:
-    """Query the GPT model with retry logic."""
-    for attempt in range(retries):
-        try:
-            # Set parameters based on model type
-            params = {
-                "model": MODEL_NAME,
-                "messages": [{"role": "user", "content": prompt}]
+def multi_response_format(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Structured Outputs schema with one required answer per item number, each with its own choices."""
+    answers = {
+        str(number): item_response_format(item)["json_schema"]["schema"]
+        for number, item in enumerate(items, 1)
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "emotion_cause_batch",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": answers,
+                "required": list(answers),
+                "additionalProperties": False
             }
-            
-            # Different models use different parameter names for token limits and formats
-            if MODEL_NAME.startswith("o4"):
-                # For o4 models:
-                # 1. Use higher token limit
-                # 2. For o4-mini, response_format can sometimes cause issues
-                params["max_completion_tokens"] = 2000
-                
-                # o4-mini doesn't support custom temperature, only default (1)
-                # Don't set temperature at all for o4-mini
-                
-                # Only use response_format if not o4-mini specifically
-                if MODEL_NAME != "o4-mini":
-                    params["response_format"] = {"type": "json_object"}
-                    # Only set temperature for non-o4-mini models
-                    params["temperature"] = 0
-                else:
-                    # For o4-mini, add explicit instruction for JSON format
-                    params["messages"][0]["content"] += "\n\nIMPORTANT: Your response MUST be in valid JSON format with the fields 'emotion' and 'cause' only."
+        }
+    }
+
+def build_request_params(prompt: str, response_format: Dict[str, Any], answers: int = 1) -> Dict[str, Any]:
+    """Build chat completion parameters for the configured model, sized for `answers` answers."""
+    # Set parameters based on model type
+    params = {
+        "model": MODEL_NAME,
+        "messages": [{"role": "user", "content": prompt}]
+    }
+    
+    # Different models use different parameter names for token limits and formats
+    if MODEL_NAME.startswith("o4"):
+        # For o4 models:
+        # 1. Use higher token limit
+        # 2. For o4-mini, response_format can sometimes cause issues
+        params["max_completion_tokens"] = 2000 * answers
+        
+        # o4-mini doesn't support custom temperature, only default (1)
+        # Don't set temperature at all for o4-mini
+        
+        # Only use response_format if not o4-mini specifically
+        if MODEL_NAME != "o4-mini":
+            params["response_format"] = response_format
+            # Only set temperature for non-o4-mini models
+            params["temperature"] = 0
+        else:
+            # For o4-mini, add explicit instruction for JSON format
+            if answers == 1:
+                params["messages"][0]["content"] += "\n\nIMPORTANT: Your response MUST be in valid JSON format with the fields 'emotion' and 'cause' only."
             else:
-                params["max_tokens"] = 500
-                params["temperature"] = 0
-                params["response_format"] = {"type": "json_object"}
+                params["messages"][0]["content"] += "\n\nIMPORTANT: Your response MUST be a valid JSON object keyed by scenario number, each value with the fields 'emotion' and 'cause' only."
+    else:
+        params["max_tokens"] = STRUCTURED_MAX_TOKENS * answers
+        params["temperature"] = 0
+        params["response_format"] = response_format
+    
+    return params
+
+def handle_response(response: Any, params: Dict[str, Any], key: str, attempt: int,
+                    retries: int) -> Optional[Dict[str, Any]]:
+    """Parse a chat completion, caching it; None asks the caller to retry with the (simplified) params.
+    
+    Raises ValueError for unusable responses so the caller retries them like any other failed request.
+    """
+    # Debug logging; guarded so the reprs are never built on normal runs
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Response type: {type(response)}")
+        logger.debug(f"Response choices: {response.choices}")
+    
+    if not response.choices:
+        raise ValueError("No choices in response")
+    
+    content = response.choices[0].message.content
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Message content type: {type(content)}")
+        logger.debug(f"Raw message content: {repr(content)}")
+    
+    # Check for empty content
+    if not content or not content.strip():
+        # Try a simpler prompt if this was an empty response
+        if (attempt < retries - 1 and MODEL_NAME == "o4-mini"
+                and not params["messages"][0]["content"].startswith(MULTI_PROMPT_INSTRUCTIONS)):
+            logger.error("Received empty response from model")
+            logger.info(f"Retrying with simpler prompt...")
+            # Simplify prompt for retry
+            prompt = params["messages"][0]["content"]
+            simple_scenario = prompt.split('Scenario: ')[1].split('\n\nSubject:')[0]
+            simple_subject = prompt.split('Subject: ')[1].split('\n')[0]
+            simple_prompt = f'From this scenario: "{simple_scenario}", the subject is "{simple_subject}". '
+            simple_prompt += 'What is their emotion and its cause? Reply only with JSON: {"emotion": "chosen_emotion", "cause": "chosen_cause"}'
             
+            params["messages"][0]["content"] = simple_prompt
+            return None
+        raise ValueError("Received empty response from model")
+    
+    try:
+        parsed = json_loads(content)
+    except ValueError as je:
+        logger.error(f"Content that failed to parse: {repr(content)}")
+        raise ValueError(f"Non-JSON response received: {je}") from je
+    if not isinstance(parsed, dict):
+        raise ValueError(f"Response is not a JSON object: {content!r}")
+    cache_put(key, content)
+    return parsed
+
+def query_gpt(prompt: str, response_format: Dict[str, Any], answers: int = 1, retries: int = 3,
+              retry_delay: int = 5) -> Optional[Dict[str, Any]]:
+    """Query the GPT model with retry logic, answering from the response cache when possible."""
+    # Built once so a simplified retry prompt set by handle_response is kept; the key is taken first
+    params = build_request_params(prompt, response_format, answers)
+    key = cache_key(prompt, params)
+    cached = cache_get(key)
+    if cached is not None:
+        return json_loads(cached)
+    if REPLAY_ONLY:
+        logger.warning("No cached response for prompt and --replay-only is set")
+        return None
+    
+    # Constrained decoding guarantees valid JSON with in-range answers, so malformed output no longer burns a retry.
+    last_error = None
+    for attempt in range(retries):
+        try:
             # Log the parameters we're using
-            logger.info(f"Querying model with parameters: {params}")
-                
-            response = client.chat.completions.create(**params)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Querying model with parameters: {params}")
             
-            # Debug logging
-            logger.info(f"Response type: {type(response)}")
-            logger.info(f"Response choices: {response.choices}")
-            
-            if len(response.choices) > 0:
-                logger.info(f"Message content type: {type(response.choices[0].message.content)}")
-                logger.info(f"Raw message content: {repr(response.choices[0].message.content)}")
+            wait_for_capacity(params)
+            response = client.chat.completions.create(**params)
+            release_unused_tokens(params, response)
+            parsed = handle_response(response, params, key, attempt, retries)
+            if parsed is not None:
+                return parsed
                 
-                # Check for empty content
-                if not response.choices[0].message.content.strip():
-                    logger.error("Received empty response from model")
-                    if attempt < retries - 1:
-                        logger.info(f"Retrying with simpler prompt...")
-                        # Try a simpler prompt if this was an empty response
-                        if MODEL_NAME == "o4-mini":
-                            # Simplify prompt for retry
-                            simple_scenario = prompt.split('Scenario: ')[1].split('\n\nSubject:')[0]
-                            simple_subject = prompt.split('Subject: ')[1].split('\n\nEmotion choices:')[0]
-                            simple_prompt = f'From this scenario: "{simple_scenario}", the subject is "{simple_subject}". '
-                            simple_prompt += 'What is their emotion and its cause? Reply only with JSON: {"emotion": "chosen_emotion", "cause": "chosen_cause"}'
-                            
-                            params["messages"][0]["content"] = simple_prompt
-                            continue
-                    else:
-                        logger.error("Empty response after all retries. Exiting.")
-                        sys.exit(1)
+        except AuthenticationError as e:
+            # Every later request would fail the same way
+            logger.error(f"Authentication failed: {str(e)}. Exiting.")
+            sys.exit(1)
+        except Exception as e:
+            last_error = f"{type(e).__name__}: {e}"
+            if isinstance(e, RateLimitError):
+                logger.warning(f"Rate limited by the API (attempt {attempt+1}/{retries})")
             else:
-                logger.error("No choices in response")
-                sys.exit(1)
+                logger.error(f"Error querying GPT (attempt {attempt+1}/{retries}): {str(e)}")
+            if attempt < retries - 1:
+                delay = backoff_delay(attempt, retry_delay)
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+    
+    # Give up on this prompt only; the caller skips its items and records them as failures
+    logger.error("Max retries reached for this prompt.")
+    if answers == 1:
+        # Unanswered multi-question prompts are re-asked one question at a time, so only singles fail items
+        QUERY_ERRORS[prompt] = last_error
+    return None
+
+async def query_gpt_async(async_client: AsyncOpenAI, prompt: str, response_format: Dict[str, Any],
+                          answers: int = 1, retries: int = 3, retry_delay: int = 5) -> Optional[Dict[str, Any]]:
+    """Async counterpart of query_gpt using a shared AsyncOpenAI client."""
+    # Built once so a simplified retry prompt set by handle_response is kept; the key is taken first
+    params = build_request_params(prompt, response_format, answers)
+    key = cache_key(prompt, params)
+    cached = cache_get(key)
+    if cached is not None:
+        return json_loads(cached)
+    if REPLAY_ONLY:
+        logger.warning("No cached response for prompt and --replay-only is set")
+        return None
+    
+    last_error = None
+    for attempt in range(retries):
+        try:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Querying model with parameters: {params}")
             
-            # Parse JSON or exit
-            try:
-                # Try direct JSON parsing
-                if response.choices[0].message.content:
-                    try:
-                        return json.loads(response.choices[0].message.content)
-                    except json.JSONDecodeError as je:
-                        logger.error(f"JSON decode error: {je}")
-                        logger.error(f"Content that failed to parse: {repr(response.choices[0].message.content)}")
-                        logger.error("Non-JSON response received. Exiting.")
-                        sys.exit(1)
-                else:
-                    logger.error("Empty response content. Exiting.")
-                    sys.exit(1)
-                    
-            except Exception as je:
-                logger.error(f"Error parsing response: {je}")
-                logger.error("Exiting due to invalid response format.")
-                sys.exit(1)
+            await wait_for_capacity_async(params)
+            response = await async_client.chat.completions.create(**params)
+            release_unused_tokens(params, response)
+            parsed = handle_response(response, params, key, attempt, retries)
+            if parsed is not None:
+                return parsed
                 
+        except AuthenticationError as e:
+            # Every later request would fail the same way
+            logger.error(f"Authentication failed: {str(e)}. Exiting.")
+            sys.exit(1)
         except Exception as e:
-            logger.error(f"Error querying GPT (attempt {attempt+1}/{retries}): {str(e)}")
-            if attempt < retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+            last_error = f"{type(e).__name__}: {e}"
+            if isinstance(e, RateLimitError):
+                logger.warning(f"Rate limited by the API (attempt {attempt+1}/{retries})")
             else:
-                logger.error("Max retries reached. Exiting.")
-                sys.exit(1)
+                logger.error(f"Error querying GPT (attempt {attempt+1}/{retries}): {str(e)}")
+            if attempt < retries - 1:
+                delay = backoff_delay(attempt, retry_delay)
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+    
+    # Give up on this prompt only; the caller skips its items and records them as failures
+    logger.error("Max retries reached for this prompt.")
+    if answers == 1:
+        # Unanswered multi-question prompts are re-asked one question at a time, so only singles fail items
+        QUERY_ERRORS[prompt] = last_error
+    return None
+
+def normalize_answer(text: str) -> str:
+    """Lowercase and collapse whitespace so formatting slips don't decide correctness."""
+    return " ".join(text.strip().lower().split())
+
+@functools.lru_cache(maxsize=4096)
+def choice_lookup(choices: tuple) -> Dict[str, str]:
+    """Map each normalized choice back to its original text."""
+    return {normalize_answer(choice): choice for choice in choices}
+
+def match_choice(predicted: Any, choices: List[str]) -> Any:
+    """Map a predicted answer to the choice it equals up to case and whitespace, or return it unchanged.
+    
+    No fuzzy matching: many choices differ by one word, so a near miss is a different answer.
+    """
+    if not isinstance(predicted, str) or predicted in choices:
+        return predicted
+    return choice_lookup(tuple(choices)).get(normalize_answer(predicted), predicted)
 
 def evaluate_responses(gpt_response: Dict[str, str], item: Dict[str, Any]) -> Dict[str, Any]:
     """Evaluate GPT's responses against the ground truth."""
     true_emotion = item["emotion_label"]
     true_cause = item["cause_label"]
     
+    # The raw predictions are recorded; only the correctness check tolerates formatting slips
     predicted_emotion = gpt_response.get("emotion", "")
     predicted_cause = gpt_response.get("cause", "")
     
-    emotion_correct = predicted_emotion == true_emotion
-    cause_correct = predicted_cause == true_cause
+    emotion_correct = match_choice(predicted_emotion, item["emotion_choices"]) == true_emotion
+    cause_correct = match_choice(predicted_cause, item["cause_choices"]) == true_cause
     
     return {
         "qid": item["qid"],
@@ -220,51 +667,375 @@ def evaluate_responses(gpt_response: Dict[str, str], item: Dict[str, Any]) -> Di
         "both_correct": emotion_correct and cause_correct
     }
 
-def run_test(data: List[Dict[str, Any]], limit: Optional[int] = None, resume: bool = False) -> None:
-    """Run the test on the provided data."""
+def progress_bar_options(total: int) -> Dict[str, Any]:
+    """tqdm settings that redraw at most once a second and are off when stderr is not a terminal."""
+    return {"mininterval": 1.0, "miniters": max(1, total // 500), "disable": not sys.stderr.isatty()}
+
+def select_items(data: Iterable[Dict[str, Any]], limit: Optional[int] = None,
+                 resume: bool = False) -> tuple:
+    """Return (processed_ids, processed_set, items) for this run, applying --resume and --limit."""
     processed_ids = load_progress() if resume else []
+    # Set mirror of processed_ids for O(1) membership; the list keeps completion order for progress.json
+    processed_set = set(processed_ids)
     
-    # Filter out already processed items if resuming
+    # Filter out already processed items if resuming, in the same pass as loading
     if resume and processed_ids:
         logger.info(f"Resuming from previous run. {len(processed_ids)} items already processed.")
-        data_to_process = [item for item in data if item["qid"] not in processed_ids]
-    else:
-        data_to_process = data
+        data = (item for item in data if item["qid"] not in processed_set)
     
     # Apply limit if specified
     if limit is not None:
-        data_to_process = data_to_process[:limit]
+        data = islice(data, limit)
     
-    logger.info(f"Processing {len(data_to_process)} items...")
+    # Only the items selected for this run are held in memory
+    return processed_ids, processed_set, list(data)
+
+def group_by_prompt(items: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """Group items by prompt text so identical prompts share one model call.
     
-    for item in tqdm(data_to_process, desc="Testing"):
-        prompt = create_prompt(item)
-        gpt_response = query_gpt(prompt)
-        
+    Groups are ordered by choice lists so prompts with the same prefix are sent back to back.
+    """
+    prompt_groups = defaultdict(list)
+    for item in sorted(items, key=lambda item: (item["emotion_choices"], item["cause_choices"])):
+        prompt_groups[create_prompt(item)].append(item)
+    return prompt_groups
+
+def record_results(results_fh: BinaryIO, progress_fh: BinaryIO, items: List[Dict[str, Any]],
+                   gpt_response: Optional[Dict[str, Any]], processed_ids: List[str], processed_set: set,
+                   unsaved_count: int) -> int:
+    """Save one answer for every item sharing its prompt, flushing progress periodically.
+    
+    Returns the updated count of results saved since the last progress flush.
+    """
+    # Every item of a group shares the prompt the error was recorded under
+    error = QUERY_ERRORS.pop(create_prompt(items[0]), None) if not gpt_response else None
+    for item in items:
         if gpt_response:
-            result = evaluate_responses(gpt_response, item)
-            save_result(result)
-            processed_ids.append(item["qid"])
-            save_progress(processed_ids)
+            save_result(results_fh, evaluate_responses(gpt_response, item))
+            if item["qid"] not in processed_set:
+                processed_set.add(item["qid"])
+                processed_ids.append(item["qid"])
+                append_progress(progress_fh, item["qid"])
+            unsaved_count += 1
+            if unsaved_count >= PROGRESS_FLUSH_INTERVAL:
+                flush_progress(results_fh, progress_fh)
+                unsaved_count = 0
         else:
             logger.warning(f"Skipping item {item['qid']} due to failed GPT query.")
+            # --replay-only misses are expected, not failures
+            if not REPLAY_ONLY:
+                record_failure(item, error)
+    return unsaved_count
+
+def chunk_groups(prompt_groups: Dict[str, List[Dict[str, Any]]], size: int) -> List[List[tuple]]:
+    """Split (prompt, items) groups into chunks of up to `size` unique prompts, one model call each."""
+    groups = list(prompt_groups.items())
+    return [groups[i:i + size] for i in range(0, len(groups), size)]
+
+def split_answers(chunk: List[tuple], parsed: Optional[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    """Pick each group's answer out of a multi-question response; None where it is missing."""
+    answers = []
+    for number, (_, items) in enumerate(chunk, 1):
+        answer = parsed.get(str(number)) if isinstance(parsed, dict) else None
+        if not isinstance(answer, dict):
+            logger.warning(f"No answer for item {items[0]['qid']} in multi-question response; querying it alone")
+            answer = None
+        answers.append(answer)
+    return answers
+
+def query_chunk(chunk: List[tuple]) -> List[tuple]:
+    """Answer a chunk of prompt groups with one request, re-asking singly for any missing answer."""
+    if len(chunk) == 1:
+        prompt, items = chunk[0]
+        return [(items, query_gpt(prompt, item_response_format(items[0])))]
+    
+    representatives = [items[0] for _, items in chunk]
+    parsed = query_gpt(create_multi_prompt(representatives), multi_response_format(representatives),
+                       answers=len(chunk))
+    return [(items, answer if answer is not None else query_gpt(prompt, item_response_format(items[0])))
+            for (prompt, items), answer in zip(chunk, split_answers(chunk, parsed))]
+
+async def query_chunk_async(async_client: AsyncOpenAI, chunk: List[tuple]) -> List[tuple]:
+    """Async counterpart of query_chunk."""
+    if len(chunk) == 1:
+        prompt, items = chunk[0]
+        return [(items, await query_gpt_async(async_client, prompt, item_response_format(items[0])))]
+    
+    representatives = [items[0] for _, items in chunk]
+    parsed = await query_gpt_async(async_client, create_multi_prompt(representatives),
+                                   multi_response_format(representatives), answers=len(chunk))
+    results = []
+    for (prompt, items), answer in zip(chunk, split_answers(chunk, parsed)):
+        if answer is None:
+            answer = await query_gpt_async(async_client, prompt, item_response_format(items[0]))
+        results.append((items, answer))
+    return results
+
+def run_test(data: Iterable[Dict[str, Any]], limit: Optional[int] = None, resume: bool = False,
+             workers: int = 1, items_per_request: int = 1) -> None:
+    """Run the test on the provided data, querying the model with a pool of worker threads."""
+    processed_ids, processed_set, data_to_process = select_items(data, limit, resume)
+    
+    # Items with identical prompts share one model call; the answer is fanned out to each of them
+    prompt_groups = group_by_prompt(data_to_process)
+    logger.info(f"Processing {len(data_to_process)} items ({len(prompt_groups)} unique prompts) "
+                f"with {workers} worker(s)...")
+    
+    # Guards the results file and the progress list shared by completed futures
+    write_lock = threading.Lock()
+    unsaved_count = saved_count = 0
+    
+    # Keep one buffered handle each open for the whole run instead of reopening per result
+    with open(RESULTS_FILE, 'ab', buffering=1 << 20) as results_fh, open(PROGRESS_LOG, 'ab') as progress_fh:
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(query_chunk, chunk)
+                           for chunk in chunk_groups(prompt_groups, items_per_request)]
+                
+                total = len(data_to_process)
+                try:
+                    with tqdm(total=total, desc="Testing", **progress_bar_options(total)) as progress:
+                        for future in as_completed(futures):
+                            for items, gpt_response in future.result():
+                                with write_lock:
+                                    unsaved_count = record_results(results_fh, progress_fh, items, gpt_response,
+                                                                   processed_ids, processed_set, unsaved_count)
+                                    saved_count += len(items) if gpt_response else 0
+                                progress.update(len(items))
+                except BaseException:
+                    # Don't start queued requests after a fatal error (e.g. bad API key) or Ctrl+C
+                    executor.shutdown(cancel_futures=True)
+                    raise
+        finally:
+            # Final snapshot so progress covers every saved result, including on Ctrl+C or early exit
+            with write_lock:
+                flush_progress(results_fh, progress_fh)
+                save_progress(processed_ids, results_fh)
     
-    logger.info(f"Testing complete. Processed {len(processed_ids)} items in total.")
+    # EN and ZH items share qids, so the saved results, not the unique qids, count the items
+    logger.info(f"Testing complete. Saved {saved_count} results ({len(processed_ids)} unique qids processed in total).")
+
+async def run_test_async(data: Iterable[Dict[str, Any]], limit: Optional[int] = None, resume: bool = False,
+                         workers: int = 1, items_per_request: int = 1) -> None:
+    """Run the test with asyncio, keeping at most `workers` requests in flight on one thread."""
+    processed_ids, processed_set, data_to_process = select_items(data, limit, resume)
+    prompt_groups = group_by_prompt(data_to_process)
+    logger.info(f"Processing {len(data_to_process)} items ({len(prompt_groups)} unique prompts) "
+                f"with up to {workers} concurrent request(s)...")
+    
+    semaphore = asyncio.Semaphore(workers)
+    unsaved_count = saved_count = 0
+    
+    async def query_limited(async_client: AsyncOpenAI, chunk: List[tuple]) -> List[tuple]:
+        async with semaphore:
+            return await query_chunk_async(async_client, chunk)
+    
+    with open(RESULTS_FILE, 'ab', buffering=1 << 20) as results_fh, open(PROGRESS_LOG, 'ab') as progress_fh:
+        try:
+            # Size the connection pool to the concurrency so requests never queue inside the client
+            # DefaultAsyncHttpxClient keeps the SDK's own client defaults, e.g. following redirects
+            http_client = DefaultAsyncHttpxClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=workers, max_keepalive_connections=workers),
+                timeout=Timeout(600.0, connect=5.0)
+            )
+            async with AsyncOpenAI(api_key=api_key, http_client=http_client) as async_client:
+                tasks = [asyncio.ensure_future(query_limited(async_client, chunk))
+                         for chunk in chunk_groups(prompt_groups, items_per_request)]
+                
+                total = len(data_to_process)
+                with tqdm(total=total, desc="Testing", **progress_bar_options(total)) as progress:
+                    # Results are written from the event loop thread only, so no lock is needed
+                    for task in asyncio.as_completed(tasks):
+                        for items, gpt_response in await task:
+                            unsaved_count = record_results(results_fh, progress_fh, items, gpt_response,
+                                                           processed_ids, processed_set, unsaved_count)
+                            saved_count += len(items) if gpt_response else 0
+                            progress.update(len(items))
+        finally:
+            flush_progress(results_fh, progress_fh)
+            save_progress(processed_ids, results_fh)
+    
+    logger.info(f"Testing complete. Saved {saved_count} results ({len(processed_ids)} unique qids processed in total).")
+
+def build_batch_file(data: List[Dict[str, Any]], path: str) -> None:
+    """Write one Batch API request per item, using the item's position in data as its custom_id."""
+    # qids are shared between the English and Chinese copies of a question, so they can't be custom_ids
+    with open(path, 'wb', buffering=1 << 20) as f:
+        for i, item in enumerate(data):
+            response_format = item_response_format(item)
+            request = {
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_request_params(create_prompt(item), response_format)
+            }
+            f.write(json_dumps(request) + b'\n')
+
+def submit_batch(path: str) -> str:
+    """Upload a batch input file and start a batch job, returning its id."""
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    logger.info(f"Submitted batch {batch.id}")
+    return batch.id
+
+def save_batch_state(batch_id: str, items: List[Dict[str, Any]]) -> None:
+    """Remember a submitted batch job and the items its custom_ids index into."""
+    tmp_file = f"{BATCH_STATE_FILE}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(json_dumps({"batch_id": batch_id, "items": items}))
+    os.replace(tmp_file, BATCH_STATE_FILE)
+
+def load_batch_state() -> Optional[Dict[str, Any]]:
+    """Return the batch job left by an interrupted --batch run, if any."""
+    try:
+        with open(BATCH_STATE_FILE, 'rb') as f:
+            return json_loads(f.read())
+    except FileNotFoundError:
+        return None
+
+def log_batch_errors(batch: Any) -> None:
+    """Log the job-level errors of a batch that failed or expired."""
+    errors = batch.errors.data if batch.errors is not None and batch.errors.data else []
+    for error in errors:
+        logger.error(f"Batch {batch.id} error {error.code} (line {error.line}): {error.message}")
+    if not errors:
+        logger.error(f"Batch {batch.id} {batch.status} without job-level errors")
+
+def wait_for_batch(batch_id: str) -> Any:
+    """Poll a batch job until it reaches a terminal status."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in BATCH_TERMINAL_STATUSES:
+            return batch
+        counts = batch.request_counts
+        if counts is not None:
+            logger.info(f"Batch {batch_id} {batch.status}: {counts.completed}/{counts.total} done, {counts.failed} failed")
+        else:
+            logger.info(f"Batch {batch_id} {batch.status}")
+        time.sleep(BATCH_POLL_INTERVAL)
+
+def batch_line_answer(line: Dict[str, Any]) -> tuple:
+    """Return the content and parsed answer of one batch output line.
+    
+    Raises ValueError for unusable lines, with the same checks handle_response applies.
+    """
+    response = line.get("response")
+    if line.get("error") or response is None or response["status_code"] != 200:
+        raise ValueError(f"batch request failed: {line.get('error') or response}")
+    choices = response.get("body", {}).get("choices")
+    content = choices[0].get("message", {}).get("content") if choices else None
+    if not content or not content.strip():
+        raise ValueError("empty response from model")
+    try:
+        parsed = json_loads(content)
+    except ValueError:
+        raise ValueError(f"non-JSON response {content!r}") from None
+    if not isinstance(parsed, dict):
+        raise ValueError(f"response is not a JSON object {content!r}")
+    return content, parsed
+
+def run_batch(data: Iterable[Dict[str, Any]], limit: Optional[int] = None, resume: bool = False) -> None:
+    """Run the test through the Batch API, answering cached prompts locally.
+    
+    A job left unfinished by an interrupted run is collected first, instead of selecting new items.
+    """
+    processed_ids, processed_set, data_to_process = select_items(data, limit, resume)
+    
+    answered = []
+    saved_batch = load_batch_state()
+    if saved_batch is not None:
+        batch_id, pending = saved_batch["batch_id"], saved_batch["items"]
+        logger.info(f"Resuming batch {batch_id} for its {len(pending)} items; run --batch again for any others")
+    else:
+        # Only prompts without a cached response are sent to the batch job
+        pending = []
+        for item in data_to_process:
+            cached = cache_get(item_cache_key(item))
+            if cached is not None:
+                answered.append((item, json_loads(cached)))
+            else:
+                pending.append(item)
+        logger.info(f"Processing {len(data_to_process)} items: {len(answered)} cached, {len(pending)} via batch")
+        
+        batch_id = None
+        if pending:
+            build_batch_file(pending, BATCH_INPUT_FILE)
+            batch_id = submit_batch(BATCH_INPUT_FILE)
+            save_batch_state(batch_id, pending)
+    
+    answered_indices = set()
+    batch_errors = {}
+    if batch_id is not None:
+        batch = wait_for_batch(batch_id)
+        logger.info(f"Batch {batch.id} finished with status {batch.status}")
+        if batch.status in ("failed", "expired"):
+            log_batch_errors(batch)
+        
+        # Requests that failed individually are reported in the error file, in the same line format
+        for file_id, path in ((batch.output_file_id, BATCH_OUTPUT_FILE), (batch.error_file_id, BATCH_ERROR_FILE)):
+            if not file_id:
+                continue
+            with open(path, 'wb') as f:
+                f.write(client.files.content(file_id).content)
+            for line in iter_data(path):
+                index = int(line["custom_id"])
+                item = pending[index]
+                try:
+                    content, parsed = batch_line_answer(line)
+                except ValueError as e:
+                    # One bad line must not abort a run that waited on the batch
+                    logger.warning(f"Skipping item {item['qid']}: {e}")
+                    batch_errors[index] = str(e)
+                    continue
+                cache_put(item_cache_key(item), content)
+                answered.append((item, parsed))
+                answered_indices.add(index)
+        if len(answered_indices) < len(pending):
+            logger.warning(f"{len(pending) - len(answered_indices)} item(s) got no usable batch response")
+            for index, item in enumerate(pending):
+                if index not in answered_indices:
+                    record_failure(item, batch_errors.get(index, f"no batch output (batch {batch.status})"))
+    
+    with open(RESULTS_FILE, 'ab', buffering=1 << 20) as results_fh:
+        try:
+            for item, gpt_response in answered:
+                save_result(results_fh, evaluate_responses(gpt_response, item))
+                if item["qid"] not in processed_set:
+                    processed_set.add(item["qid"])
+                    processed_ids.append(item["qid"])
+        finally:
+            save_progress(processed_ids, results_fh)
+    
+    # The job's results are recorded, so a later run must not collect it again
+    if batch_id is not None:
+        os.remove(BATCH_STATE_FILE)
+    
+    saved_count = len(answered)
+    logger.info(f"Testing complete. Saved {saved_count} results ({len(processed_ids)} unique qids processed in total).")
 
 def calculate_statistics() -> Dict[str, Any]:
     """Calculate statistics from the results file."""
     if not Path(RESULTS_FILE).exists():
         return {"error": "No results file found"}
     
-    results = []
-    with open(RESULTS_FILE, 'r', encoding='utf-8') as f:
+    # Fold the counters in a single streaming pass without retaining rows
+    total = emotion_correct = cause_correct = both_correct = 0
+    with open(RESULTS_FILE, 'rb', buffering=1 << 20) as f:
         for line in f:
-            results.append(json.loads(line))
-    
-    total = len(results)
-    emotion_correct = sum(1 for r in results if r["emotion_correct"])
-    cause_correct = sum(1 for r in results if r["cause_correct"])
-    both_correct = sum(1 for r in results if r["both_correct"])
+            # orjson parses as fast as a byte scan; without it, read the flags straight off the raw line
+            match = CORRECT_FLAGS_PATTERN.search(line) if orjson is None else None
+            if match:
+                flags = [value == b'true' for value in match.groups()]
+            else:
+                r = json_loads(line)
+                flags = [r["emotion_correct"], r["cause_correct"], r["both_correct"]]
+            total += 1
+            emotion_correct += flags[0]
+            cause_correct += flags[1]
+            both_correct += flags[2]
     
     return {
         "total_items": total,
@@ -273,30 +1044,78 @@ def calculate_statistics() -> Dict[str, Any]:
         "both_correct_accuracy": both_correct / total if total > 0 else 0
     }
 
+def positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def main():
     """Main function to run the test."""
     parser = argparse.ArgumentParser(description="Test GPT-4.1-nano on EU.jsonl")
     parser.add_argument("--limit", type=int, help="Limit the number of records to test")
     parser.add_argument("--resume", action="store_true", help="Resume from previous run")
+    parser.add_argument("--workers", type=positive_int, default=1, help="Number of concurrent model requests")
+    parser.add_argument("--no-cache", action="store_true", help="Always query the API, bypassing the response cache")
+    parser.add_argument("--replay-only", action="store_true",
+                        help="Only use cached responses; items without one are skipped")
+    parser.add_argument("--items-per-request", type=positive_int, default=1,
+                        help="Ask this many questions in one model request (default 1)")
+    parser.add_argument("--max-requests-per-minute", type=int,
+                        help="Client-side request rate limit (default: unlimited)")
+    parser.add_argument("--max-tokens-per-minute", type=int,
+                        help="Client-side token rate limit, counting prompt plus max completion tokens")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Use a single-threaded asyncio/AsyncOpenAI client instead of a thread pool")
+    parser.add_argument("--batch", action="store_true",
+                        help="Submit uncached prompts as one OpenAI Batch API job (cheaper, results within 24h)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Log request parameters and raw model responses")
     args = parser.parse_args()
     
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
     setup_directories()
+    configure_rate_limits(args.max_requests_per_minute, args.max_tokens_per_minute)
+    
+    global REPLAY_ONLY
+    if not args.no_cache and not responses_are_deterministic():
+        # Sampled responses differ run to run; replaying one would hide that variance
+        if args.replay_only:
+            logger.error(f"{MODEL_NAME} is not queried at temperature 0, so its responses are not cached; "
+                         "--replay-only is unavailable")
+            return
+        logger.info(f"Response cache disabled: {MODEL_NAME} is not queried at temperature 0")
+    elif not args.no_cache:
+        open_cache()
+        REPLAY_ONLY = args.replay_only
     
     # Check if API key is set
     if not api_key:
         logger.error("OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
         return
     
-    # Load data
-    try:
-        data = load_data(INPUT_FILE)
-        logger.info(f"Loaded {len(data)} records from {INPUT_FILE}")
-    except Exception as e:
-        logger.error(f"Error loading data: {str(e)}")
+    # Records are streamed from the input file while the test runs
+    if not Path(INPUT_FILE).exists():
+        logger.error(f"Error loading data: input file {INPUT_FILE} not found")
         return
+    logger.info(f"Streaming records from {INPUT_FILE}")
     
-    # Run test
-    run_test(data, limit=args.limit, resume=args.resume)
+    # When resuming, finished records are dropped while streaming, before they are parsed
+    data = iter_data(INPUT_FILE, skip_qids=set(load_progress()) if args.resume else None)
+    
+    # Run test; --replay-only never calls the API, so it always takes the synchronous path
+    if args.batch and not REPLAY_ONLY:
+        run_batch(data, limit=args.limit, resume=args.resume)
+    elif args.use_async:
+        loop_factory = uvloop.new_event_loop if uvloop is not None else None
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(run_test_async(data, limit=args.limit, resume=args.resume,
+                                      workers=args.workers, items_per_request=args.items_per_request))
+    else:
+        run_test(data, limit=args.limit, resume=args.resume, workers=args.workers,
+                 items_per_request=args.items_per_request)
     
     # Calculate and display statistics
     stats = calculate_statistics()
@@ -308,4 +1127,4 @@ def main():
             logger.info(f"{key}: {value}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main() 